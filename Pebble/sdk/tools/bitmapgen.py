@@ -7,6 +7,14 @@ import struct
 import sys
 from PIL import Image
 
+import bitpack
+import fileutil
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 WHITE_COLOR_MAP = {
     'white' : 1,
     'black' : 0,
@@ -36,6 +44,7 @@ class PebbleBitmap(object):
         self.name, _ = os.path.splitext(os.path.basename(path))
         self.image = Image.open(path).convert("RGBA")
         self.color_map = color_map
+        self._pixel_classes = None
 
         if not self.image:
             self.width = 0
@@ -73,19 +82,55 @@ class PebbleBitmap(object):
                            self.w,
                            self.h)
 
-    def image_bits(self):
+    def pixel_classes(self):
+        """
+        Return (transparent, black) boolean arrays covering the pixels that
+        end up in the bitmap. Computed once and shared by every color map.
+        """
+
+        if self._pixel_classes is None:
+            row_size_bits = self.row_size_bytes() * 8
+            pixels = numpy.asarray(self.image, dtype=numpy.uint16)
+            pixels = pixels[self.y:self.y + self.h, self.x:self.x + row_size_bits]
+
+            # Same thresholds as the reference loop: (r + g + b) / 3 < 127 is r + g + b < 381
+            transparent = pixels[:, :, 3] < 127
+            black = (pixels[:, :, 0] + pixels[:, :, 1] + pixels[:, :, 2]) < 381
+            self._pixel_classes = (transparent, black)
+        return self._pixel_classes
+
+    def image_bits(self, color_map=None):
         """
         Return a raw bitmap capable of being rendered using Pebble's bitblt graphics routines.
 
         The returned bitmap will always be y * row_size_bytes large.
         """
 
+        color_map = color_map or self.color_map
+        if numpy is None:
+            return self.image_bits_reference(color_map)
+
+        transparent, black = self.pixel_classes()
+        values = numpy.where(transparent, color_map['transparent'],
+                             numpy.where(black, color_map['black'], color_map['white']))
+        return bitpack.pack_rows(values, self.row_size_bytes())
+
+    def image_bits_reference(self, color_map=None):
+        """
+        Pure python version of image_bits(), one pixel at a time.
+
+        Used when numpy is not available and as the reference the vectorized
+        path is checked against.
+        """
+
+        color_map = color_map or self.color_map
+
         def get_monochrome_value_for_pixel(pixel):
             if pixel[3] < 127:
-                return self.color_map['transparent']
+                return color_map['transparent']
             if ((pixel[0] + pixel[1] + pixel[2]) / 3) < 127:
-                return self.color_map['black']
-            return self.color_map['white']
+                return color_map['black']
+            return color_map['white']
 
         def pack_pixels_to_bitblt_word(pixels, y_offset, x_offset, x_max):
             word = 0
@@ -136,17 +181,26 @@ class PebbleBitmap(object):
 
     def convert_to_h(self, header_file=None):
         to_file = header_file if header_file else (os.path.splitext(self.path)[0] + '.h')
-        with open(to_file, 'w') as f:
-            f.write(self.header())
+        # Leave an unchanged header alone so nothing including it is rebuilt
+        fileutil.write_if_changed(to_file, self.header())
         return to_file
 
-    def convert_to_pbi(self, pbi_file=None):
+    def convert_to_pbi(self, pbi_file=None, color_map=None):
         to_file = pbi_file if pbi_file else (os.path.splitext(self.path)[0] + '.pbi')
-        with open(to_file, 'wb') as f:
+        # Replace rather than overwrite, the old file may be linked into a resource cache
+        with fileutil.atomic_write(to_file) as f:
             f.write(self.pbi_header())
-            f.write(self.image_bits())
+            f.write(self.image_bits(color_map))
         return to_file
 
+    def convert_to_trans_pbi_pair(self, white_pbi_file, black_pbi_file):
+        """
+        Write both transparency layers of the image from a single decode.
+        """
+        self.convert_to_pbi(white_pbi_file, WHITE_COLOR_MAP)
+        self.convert_to_pbi(black_pbi_file, BLACK_COLOR_MAP)
+        return (white_pbi_file, black_pbi_file)
+
 def cmd_pbi(args):
     pb = PebbleBitmap(args.input_png)
     pb.convert_to_pbi(args.output_pbi)
@@ -163,6 +217,54 @@ def cmd_black_trans_pbi(args):
     pb = PebbleBitmap(args.input_png, BLACK_COLOR_MAP)
     pb.convert_to_pbi(args.output_pbi)
 
+def cmd_trans_pair(args):
+    pb = PebbleBitmap(args.input_png)
+    pb.convert_to_trans_pbi_pair(args.output_white_pbi, args.output_black_pbi)
+
+def _self_test():
+    """Check image_bits() against image_bits_reference() on random images."""
+    import random
+    import shutil
+    import tempfile
+
+    if numpy is None:
+        print "numpy isn't available, image_bits() is the reference"
+        return
+
+    rand = random.Random(0)
+    # Values either side of the alpha and brightness thresholds, and the extremes
+    levels = (0, 1, 126, 127, 128, 254, 255)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'test.png')
+        for width in (1, 7, 31, 32, 33, 63, 65, 100, 144):
+            for height in (1, 5, 17):
+                image = Image.new('RGBA', (width + 3, height + 4))
+                pixels = []
+                for y in xrange(height + 4):
+                    for x in xrange(width + 3):
+                        if y == 0 or x == 0:
+                            # An empty border, so the bitmap doesn't start at 0, 0
+                            pixels.append((0, 0, 0, 0))
+                        elif y == 2 and height > 2:
+                            # A fully transparent row, its colors random
+                            pixels.append(tuple(rand.choice(levels) for i in xrange(3)) + (0,))
+                        else:
+                            pixels.append(tuple(rand.choice(levels) for i in xrange(4)))
+                image.putdata(pixels)
+                image.save(path)
+
+                bitmap = PebbleBitmap(path)
+                for color_map in (WHITE_COLOR_MAP, BLACK_COLOR_MAP):
+                    assert(bitmap.image_bits(color_map) == bitmap.image_bits_reference(color_map))
+    finally:
+        shutil.rmtree(directory)
+
+    print "All tests passed!"
+
+def cmd_test(args):
+    _self_test()
+
 def process_all_bitmaps():
     directory = "bitmaps"
     paths = []
@@ -178,11 +280,11 @@ def process_all_bitmaps():
         to_file = b.convert_to_h()
         header_paths.append(os.path.basename(to_file))
 
-    f = open(os.path.join(directory, 'bitmaps.h'), 'w')
+    f = StringIO.StringIO()
     print>>f, '#pragma once'
     for h in header_paths:
         print>>f, "#include \"{0}\"".format(h)
-    f.close()
+    fileutil.write_if_changed(os.path.join(directory, 'bitmaps.h'), f.getvalue())
 
 def process_cmd_line_args():
     parser = argparse.ArgumentParser(description="Generate pebble-usable files from png images")
@@ -207,6 +309,15 @@ def process_cmd_line_args():
     black_pbi_parser.add_argument('output_pbi', metavar='OUTPUT_PBI', help="The pbi output file")
     black_pbi_parser.set_defaults(func=cmd_black_trans_pbi)
 
+    trans_pair_parser = subparsers.add_parser('trans_pair', help="make both the white and the black transparency layer .pbi files")
+    trans_pair_parser.add_argument('input_png', metavar='INPUT_PNG', help="The png image to process")
+    trans_pair_parser.add_argument('output_white_pbi', metavar='OUTPUT_WHITE_PBI', help="The white transparency layer pbi output file")
+    trans_pair_parser.add_argument('output_black_pbi', metavar='OUTPUT_BLACK_PBI', help="The black transparency layer pbi output file")
+    trans_pair_parser.set_defaults(func=cmd_trans_pair)
+
+    test_parser = subparsers.add_parser('test', help="check the vectorized image packing against the pixel by pixel reference on random images")
+    test_parser.set_defaults(func=cmd_test)
+
     args = parser.parse_args()
     args.func(args)
 
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Bit packing shared by bitmapgen.py and font/fontgen.py.
+#
+# Both the .pbi and the .pfo formats store 1-bit pixels LSB-first in
+# little-endian 32-bit words: pixel n of a run lands in bit (n % 32) of
+# word (n / 32).
+
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def _pack_bits_reference(bits):
+    words = []
+    bits = list(bits)
+    for start in xrange(0, len(bits), 32):
+        w = 0
+        for index, value in enumerate(bits[start:start + 32]):
+            if value:
+                w |= 1 << index
+        words.append(struct.pack('<I', w))
+    return ''.join(words)
+
+def pack_bits(bits):
+    """
+    Pack a flat sequence of truthy/falsy pixels into 32-bit words, zero
+    padding the last word.
+    """
+    if numpy is None:
+        return _pack_bits_reference(bits)
+
+    bits = numpy.asarray(bits, dtype=numpy.bool_).ravel()
+    padded = numpy.zeros((len(bits) + 31) / 32 * 32, dtype=numpy.uint8)
+    padded[:len(bits)] = bits
+    # packbits is MSB-first, so reverse each byte's worth of pixels
+    return numpy.packbits(padded.reshape(-1, 8)[:, ::-1]).tobytes()
+
+def pack_threshold(values, threshold=127):
+    """
+    Pack a flat sequence of 8-bit coverage values, setting the pixels that
+    are above threshold.
+    """
+    if numpy is None:
+        return _pack_bits_reference(v > threshold for v in values)
+    if isinstance(values, (str, bytearray)):
+        values = numpy.frombuffer(values, dtype=numpy.uint8)
+    return pack_bits(numpy.asarray(values) > threshold)
+
+def pack_rows(bits, row_size_bytes):
+    """
+    Pack a 2-D array of pixels row by row, zero padding every row out to
+    row_size_bytes. Requires numpy.
+    """
+    bits = numpy.asarray(bits, dtype=numpy.uint8)
+    rows = numpy.zeros((bits.shape[0], row_size_bytes * 8), dtype=numpy.uint8)
+    rows[:, :bits.shape[1]] = bits
+    return pack_bits(rows)
+
+if __name__ == '__main__':
+    assert(_pack_bits_reference([1, 0, 1]) == '\x05\x00\x00\x00')
+    assert(_pack_bits_reference([0] * 31 + [1, 1]) == '\x00\x00\x00\x80\x01\x00\x00\x00')
+    assert(numpy is not None), "numpy is needed to test the vectorized packing"
+
+    import random
+    rand = random.Random(0)
+    for length in range(0, 70) + [100, 143, 1000]:
+        bits = [rand.randrange(2) for i in xrange(length)]
+        expected = _pack_bits_reference(bits)
+        assert(pack_bits(bits) == expected)
+        assert(pack_bits(numpy.array(bits, dtype=numpy.bool_)) == expected)
+
+        values = [rand.choice((0, 1, 126, 127, 128, 255)) for i in xrange(length)]
+        expected = _pack_bits_reference(v > 127 for v in values)
+        assert(pack_threshold(values) == expected)
+        assert(pack_threshold(''.join(chr(v) for v in values)) == expected)
+        assert(pack_threshold(bytearray(values)) == expected)
+        assert(pack_threshold(values, 0) == _pack_bits_reference(v > 0 for v in values))
+
+    for width in (1, 7, 8, 9, 31, 32, 33, 63, 65, 100):
+        row_size_bytes = (width + 31) / 32 * 4
+        for height in (1, 3, 17):
+            rows = [[rand.randrange(2) for x in xrange(width)] for y in xrange(height)]
+            expected = ''.join(_pack_bits_reference(row + [0] * (row_size_bytes * 8 - width))
+                               for row in rows)
+            assert(pack_rows(rows, row_size_bytes) == expected)
+            # Rows padded further than the next word
+            expected = ''.join(_pack_bits_reference(row + [0] * (row_size_bytes * 8 + 32 - width))
+                               for row in rows)
+            assert(pack_rows(rows, row_size_bytes + 4) == expected)
+
+    print "All tests passed!"
@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+
+# Long-running bundling service, so that build farms making many bundles
+# don't pay for a Python startup and the imports of mkbundle.py on every one.
+#
+#   bundle_service.py serve --socket /tmp/bundler.sock
+#   bundle_service.py client --socket /tmp/bundler.sock <mkbundle.py flags> -o app.pbw
+#   bundle_service.py stats --socket /tmp/bundler.sock
+#
+# The server listens on a Unix socket (or a localhost port) and builds the
+# bundles, CRCs and compression included, on a pool of worker processes.
+# At most --max-jobs connections are read or served at a time; further
+# ones wait in the listen backlog, before their requests are read, for one
+# of them to finish, so a burst of clients is slowed down rather than
+# piling work up in memory. A stats request waits its turn like a job.
+# A client that doesn't send its request, or a job that isn't built, within
+# --timeout seconds gets an error, so a hung client or worker can't keep its
+# slot. With --root, the server only reads files sent as paths from under
+# that directory.
+#
+# Every message, either way, is a 4 byte little-endian length and that many
+# bytes of JSON, followed by the blobs the JSON lists the sizes of. A job is
+# the mkbundle.py arguments, by their argparse names. Files are sent as
+# paths for the server to read or, with the client's --send-files, inline
+# as blobs. The reply carries the job's timings and the bundle.
+
+from __future__ import print_function
+
+import SocketServer
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import mkbundle
+
+LENGTH_FORMAT = '<I'
+DEFAULT_MAX_JOBS = 64
+DEFAULT_TIMEOUT = 300
+SEND_CHUNK_SIZE = 64 * 1024
+
+# The files a job can send inline, by argument name
+INLINE_FILES = ('watchapp', 'firmware', 'resources', 'resource_map')
+
+class ServiceError(Exception):
+    pass
+
+def _recv_exactly(sock, length):
+    chunks = []
+    while length:
+        chunk = sock.recv(min(length, SEND_CHUNK_SIZE))
+        if not chunk:
+            raise ServiceError("connection closed mid-message")
+        chunks.append(chunk)
+        length -= len(chunk)
+    return ''.join(chunks)
+
+def send_message(sock, header, blobs=()):
+    """Send header, a dict, and the blobs after it; header's 'blobs' lists their sizes."""
+    header = dict(header, blobs=[len(blob) for blob in blobs])
+    encoded = json.dumps(header)
+    sock.sendall(struct.pack(LENGTH_FORMAT, len(encoded)) + encoded)
+    for blob in blobs:
+        view = buffer(blob)
+        for offset in xrange(0, len(view), SEND_CHUNK_SIZE):
+            sock.sendall(view[offset:offset + SEND_CHUNK_SIZE])
+
+def recv_message(sock):
+    """The (header, blobs) sent by send_message()."""
+    length, = struct.unpack(LENGTH_FORMAT, _recv_exactly(sock, struct.calcsize(LENGTH_FORMAT)))
+    header = json.loads(_recv_exactly(sock, length))
+    blobs = [_recv_exactly(sock, size) for size in header.get('blobs', [])]
+    return header, blobs
+
+def build_job(job):
+    """
+    Build one bundle in a worker process. job is the dict of mkbundle.py
+    arguments plus 'data', the inline files. Returns (bundle, default name,
+    seconds taken, error), where error describes what went wrong, if
+    anything, and the other fields are then None.
+    """
+    start = time.time()
+    try:
+        args = argparse.Namespace(**dict(JOB_DEFAULTS, **job['args']))
+        b = mkbundle.bundle_from_args(args, job['data'])
+        # The pool already keeps every core busy
+        b.parallel_crc = False
+        bundle = b.to_bytes(args.compress_level, args.store_resources)
+    except mkbundle.MissingFileException as e:
+        return None, None, None, "missing file {}".format(e.filename)
+    except Exception as e:
+        # Not every exception survives the trip back from the worker, its
+        # description does
+        return None, None, None, "{}: {}".format(type(e).__name__, e)
+    name = 'pebble-{}-{:d}.pbz'.format(b.type, b.generated_at)
+    return bundle, name, time.time() - start, None
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.jobs = 0
+        self.failures = 0
+        self.bytes = 0
+        self.queued = 0
+        self.wait_seconds = 0.0
+        self.build_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def record(self, wait, build, size=0, failed=False):
+        with self.lock:
+            self.jobs += 1
+            self.failures += int(failed)
+            self.bytes += size
+            self.wait_seconds += wait
+            self.build_seconds += build
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+    def as_dict(self):
+        with self.lock:
+            done = max(self.jobs, 1)
+            return {
+                'uptime_s': round(time.time() - self.started, 3),
+                'jobs': self.jobs,
+                'failures': self.failures,
+                'queued': self.queued,
+                'bytes': self.bytes,
+                'mean_wait_ms': round(1000 * self.wait_seconds / done, 3),
+                'max_wait_ms': round(1000 * self.max_wait_seconds, 3),
+                'mean_build_ms': round(1000 * self.build_seconds / done, 3),
+                }
+
+def outside_root(root, args, inline):
+    """The first of the job's files sent as a path that isn't under root, if any."""
+    root = os.path.join(os.path.realpath(root), '')
+    for key in INLINE_FILES:
+        path = args.get(key)
+        if path and key not in inline and not os.path.realpath(path).startswith(root):
+            return path
+    return None
+
+class BundleHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        self.request.settimeout(server.job_timeout)
+        try:
+            header, blobs = recv_message(self.request)
+        except (ServiceError, ValueError, socket.error) as e:
+            server.log("bad request: {}".format(e))
+            return
+
+        if header.get('command') == 'stats':
+            send_message(self.request, dict(ok=True, stats=server.metrics.as_dict()))
+            return
+
+        args = header.get('args', {})
+        inline = header.get('inline', [])
+        data = dict(zip(inline, blobs))
+        wait = server.slot_waits.pop(self.request, 0.0)
+        started = time.time()
+        path = server.root and outside_root(server.root, args, inline)
+        if path:
+            bundle, error = None, "{} is outside {}".format(path, server.root)
+        else:
+            result = server.pool.apply_async(build_job, (dict(args=args, data=data),))
+            try:
+                bundle, name, build, error = result.get(server.job_timeout)
+            except multiprocessing.TimeoutError:
+                # The worker is left to finish, or not, but the slot is freed
+                bundle, error = None, "timed out after {}s".format(server.job_timeout)
+        if error:
+            server.metrics.record(wait, time.time() - started, failed=True)
+            server.log("job failed after {:.1f}ms: {}".format(1000 * (time.time() - started), error))
+            send_message(self.request, dict(ok=False, error=error))
+            return
+
+        server.metrics.record(wait, build, len(bundle))
+        if server.verbose:
+            server.log("{}: {} bytes, waited {:.1f}ms, built in {:.1f}ms".format(
+                name, len(bundle), 1000 * wait, 1000 * build))
+        send_message(self.request, dict(ok=True, name=name, wait_ms=round(1000 * wait, 3),
+                                        build_ms=round(1000 * build, 3)), [bundle])
+
+class _ServiceMixin(SocketServer.ThreadingMixIn):
+    daemon_threads = True
+    # Connections wait here while every job slot is taken
+    request_queue_size = socket.SOMAXCONN
+
+    def setup_service(self, pool, max_jobs, verbose, timeout=DEFAULT_TIMEOUT, root=None):
+        self.pool = pool
+        self.job_timeout = timeout
+        self.root = root
+        self.job_slots = threading.BoundedSemaphore(max_jobs)
+        # How long each connection waited for its slot, by socket
+        self.slot_waits = {}
+        self.metrics = Metrics()
+        self.verbose = verbose
+
+    def process_request(self, request, client_address):
+        # Take a slot before starting a thread to read the request, so that
+        # until one is free, new connections wait unread in the backlog
+        with self.metrics.lock:
+            self.metrics.queued += 1
+        accepted = time.time()
+        self.job_slots.acquire()
+        self.slot_waits[request] = time.time() - accepted
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        try:
+            # Both servers' is TCPServer's, the mixin's bases are old-style classes
+            SocketServer.TCPServer.shutdown_request(self, request)
+        finally:
+            self.slot_waits.pop(request, None)
+            self.job_slots.release()
+            with self.metrics.lock:
+                self.metrics.queued -= 1
+
+    def log(self, message):
+        print(message, file=sys.stderr)
+
+    def shutdown_service(self):
+        self.pool.close()
+        self.pool.join()
+
+class UnixBundleServer(_ServiceMixin, SocketServer.UnixStreamServer):
+    pass
+
+class TCPBundleServer(_ServiceMixin, SocketServer.TCPServer):
+    allow_reuse_address = True
+
+def make_server(socket_path=None, port=None, workers=None, max_jobs=DEFAULT_MAX_JOBS, verbose=False,
+                timeout=DEFAULT_TIMEOUT, root=None):
+    """
+    A bundle server on the Unix socket socket_path, or on localhost:port,
+    only ever bound to the loopback interface. With root set, it only reads
+    files from under that directory.
+    """
+    # Start the pool first, so the workers are forked from a single-threaded
+    # process that isn't listening yet
+    pool = multiprocessing.Pool(workers)
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixBundleServer(socket_path, BundleHandler)
+    else:
+        server = TCPBundleServer(('127.0.0.1', port), BundleHandler)
+    server.setup_service(pool, max_jobs, verbose, timeout, root)
+    return server
+
+def connect(args):
+    if args.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(args.socket)
+    else:
+        sock = socket.create_connection(('127.0.0.1', args.port))
+    return sock
+
+def cmd_serve(args):
+    server = make_server(args.socket, args.port, args.workers, args.max_jobs, args.verbose,
+                         args.timeout, args.root)
+    server.log("bundling on {} with {} workers".format(
+        args.socket or '127.0.0.1:{}'.format(args.port), args.workers or multiprocessing.cpu_count()))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.shutdown_service()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+def cmd_client(args):
+    job = dict((key, getattr(args, key)) for key in JOB_DEFAULTS)
+    inline = []
+    blobs = []
+    for key in INLINE_FILES:
+        if job[key]:
+            path = os.path.abspath(os.path.expanduser(job[key]))
+            job[key] = path
+            if args.send_files:
+                with open(path, 'rb') as f:
+                    blobs.append(f.read())
+                inline.append(key)
+
+    start = time.time()
+    sock = connect(args)
+    try:
+        send_message(sock, dict(args=job, inline=inline), blobs)
+        header, blobs = recv_message(sock)
+    finally:
+        sock.close()
+    if not header['ok']:
+        print('bundling failed: {}'.format(header['error']), file=sys.stderr)
+        sys.exit(1)
+
+    out_path = args.outfile or header['name']
+    with open(out_path, 'wb') as f:
+        f.write(blobs[0])
+    if args.verbose:
+        print('wrote {} ({} bytes): waited {}ms, built in {}ms, {:.1f}ms in all'.format(
+            out_path, len(blobs[0]), header['wait_ms'], header['build_ms'], 1000 * (time.time() - start)))
+
+def cmd_stats(args):
+    sock = connect(args)
+    try:
+        send_message(sock, dict(command='stats'))
+        header, _ = recv_message(sock)
+    finally:
+        sock.close()
+    print(json.dumps(header['stats'], sort_keys=True))
+
+def _job_defaults():
+    parser = argparse.ArgumentParser()
+    mkbundle.add_bundle_arguments(parser)
+    return vars(parser.parse_args([]))
+
+# The mkbundle.py arguments a job carries, and their defaults
+JOB_DEFAULTS = _job_defaults()
+
+def add_address_arguments(parser):
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--socket', help='path of the Unix socket the service listens on')
+    group.add_argument('--port', type=int, help='localhost port the service listens on')
+
+def main():
+    parser = argparse.ArgumentParser(description="Build Pebble bundles in a long-running service")
+    subparsers = parser.add_subparsers(help="commands", dest='which')
+
+    serve_parser = subparsers.add_parser('serve', help="run the service")
+    add_address_arguments(serve_parser)
+    serve_parser.add_argument('--workers', type=int, help="number of bundling processes, one per core by default")
+    serve_parser.add_argument('--max-jobs', type=int, default=DEFAULT_MAX_JOBS, help="bundles queued or in progress before new jobs wait")
+    serve_parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, help="seconds to wait for a client's request, and for its bundle to be built, before failing it (default %(default)s)")
+    serve_parser.add_argument('--root', help="only read files sent as paths from under this directory")
+    serve_parser.add_argument('-v', '--verbose', action='store_true', help="log every job's size and timings")
+    serve_parser.set_defaults(func=cmd_serve)
+
+    client_parser = subparsers.add_parser('client', help="bundle through the service, taking the same flags as mkbundle.py")
+    add_address_arguments(client_parser)
+    mkbundle.add_bundle_arguments(client_parser)
+    client_parser.add_argument('-o', '--outfile', help='path to the output file')
+    client_parser.add_argument('-v', '--verbose', action='store_true', help="print the job's timings")
+    client_parser.add_argument('--send-files', action='store_true', help="send the files' contents rather than their paths, for a service that can't read them")
+    client_parser.set_defaults(func=cmd_client)
+
+    stats_parser = subparsers.add_parser('stats', help="print the service's metrics as JSON")
+    add_address_arguments(stats_parser)
+    stats_parser.set_defaults(func=cmd_stats)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
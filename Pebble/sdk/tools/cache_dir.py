@@ -0,0 +1,147 @@
+# A directory of cache entries shared between concurrent processes, the
+# common part of fontgen's glyph cache and the build's resource cache.
+#
+# Entries are written to a temporary file and renamed into place, so readers
+# only ever see complete entries. A hit bumps the entry's mtime, and the
+# least recently used entries are evicted once the directory outgrows its
+# size limit, measured in the disk blocks the entries take up.
+#
+# So that the tree isn't walked after every write, each process appends the
+# space its writes took to a usage file, and only walks the tree once the
+# total there is over the limit. The walk rewrites the file with the exact
+# figure. Writes racing with a walk can leave the total a little off until
+# the next one, which only moves that walk.
+
+import contextlib
+import errno
+import os
+import tempfile
+import threading
+import time
+
+import fileutil
+
+# Eviction trims the cache down to this fraction of its limit, so that it
+# doesn't have to run again on the very next write
+EVICT_LOW_WATER = 0.9
+
+# Temporary files left behind by a crashed writer are removed after this long
+STALE_TEMP_SECONDS = 60 * 60
+
+# Every temporary file in the cache, the usage file's included, starts with
+# this, so that a walk of the cache can tell them from entries
+TEMP_PREFIX = '.tmp-'
+
+USAGE_FILENAME = '.usage'
+
+class CacheDirectory(object):
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Disk space taken up by this process's writes
+        self.bytes_written = 0
+        self.usage_lock = threading.Lock()
+
+    def entry_path(self, name):
+        return os.path.join(self.directory, name[:2], name[2:])
+
+    @contextlib.contextmanager
+    def write_entry(self, path):
+        """
+        Open a temporary file for the entry at path, renamed into place once
+        the block exits cleanly.
+        """
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                yield f
+            added = disk_usage(os.stat(temp_path))
+            try:
+                added -= disk_usage(os.stat(path))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+        with self.usage_lock:
+            self.bytes_written += added
+
+    def _usage_path(self):
+        return os.path.join(self.directory, USAGE_FILENAME)
+
+    def record_usage(self, added):
+        """Add added bytes to the usage file. Returns the total it holds."""
+        path = self._usage_path()
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, '{:d}\n'.format(added))
+        finally:
+            os.close(fd)
+        total = 0
+        with open(path) as f:
+            for line in f:
+                try:
+                    total += int(line)
+                except ValueError:
+                    pass
+        return total
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits its limit."""
+        entries = []
+        total = 0
+        now = time.time()
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if dirpath == self.directory and filename == USAGE_FILENAME:
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if filename.startswith(TEMP_PREFIX):
+                    if now - st.st_mtime > STALE_TEMP_SECONDS:
+                        remove_quietly(path)
+                    continue
+                size = disk_usage(st)
+                entries.append((st.st_mtime, size, path))
+                total += size
+
+        removed = 0
+        if total > self.max_bytes:
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes * EVICT_LOW_WATER:
+                    break
+                remove_quietly(path)
+                total -= size
+                removed += 1
+
+        with fileutil.atomic_write(self._usage_path(), 'w', TEMP_PREFIX) as f:
+            f.write('{:d}\n'.format(total))
+        return removed
+
+    def close(self):
+        if self.bytes_written and self.record_usage(self.bytes_written) > self.max_bytes:
+            self.evict()
+
+def disk_usage(st):
+    """The disk space taken up by a file with os.stat() result st."""
+    blocks = getattr(st, 'st_blocks', None)
+    return st.st_size if blocks is None else blocks * 512
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,45 @@
+import contextlib
+import errno
+import os
+import tempfile
+
+@contextlib.contextmanager
+def atomic_write(path, mode='wb', temp_prefix=None):
+    """
+    Open a temporary file next to path for writing and rename it over path
+    once the block exits cleanly, so readers never see a partial file. The
+    temporary file's name starts with temp_prefix, by default a dot and
+    path's name.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if temp_prefix is None:
+        temp_prefix = '.' + os.path.basename(path) + '.'
+    fd, temp_path = tempfile.mkstemp(prefix=temp_prefix, dir=directory)
+    try:
+        # mkstemp creates the file 0600, give it the usual permissions instead
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0666 & ~umask)
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.rename(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def write_if_changed(path, content):
+    """
+    Write content to path unless the file already holds exactly that, so
+    that its mtime, and anything built from it, is left alone. Returns
+    whether the file was written.
+    """
+    try:
+        with open(path, 'rb') as f:
+            if f.read() == content:
+                return False
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    with atomic_write(path) as f:
+        f.write(content)
+    return True
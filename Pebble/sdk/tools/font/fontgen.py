@@ -1,14 +1,25 @@
 #!/usr/bin/env python
 
 import argparse
+import collections
+import ctypes
 import freetype
+import hashlib
+import itertools
+import json
+import multiprocessing
 import os
 import re
 import struct
 import sys
-import itertools
+import time
 from math import ceil
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bitpack
+import fileutil
+import glyph_cache
+
 # Font
 #   FontInfo
 #       (uint8_t)  version
@@ -42,18 +53,37 @@ MAX_CODEPOINT = 0xffff
 WILDCARD_CODEPOINT = 0x3456
 ELLIPSIS_CODEPOINT = 0x2026
 
-def grouper(n, iterable, fillvalue=None):
-    """grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx"""
-    args = [iter(iterable)] * n
-    return itertools.izip_longest(fillvalue=fillvalue, *args)
+# Bump when the rendering of individual glyphs changes, to invalidate cached glyphs
+GLYPH_GENERATOR_VERSION = 1
+
+# Number of codepoints handed to a worker process at a time by Font.glyphs()
+RASTERIZE_CHUNK_SIZE = 64
+
+def bitmap_coverage(bitmap):
+    """
+    Return the 8-bit coverage values of a glyph bitmap.
+
+    freetype-py's Bitmap.buffer builds a python list one byte at a time, which
+    costs more than rendering the glyph, so copy FreeType's buffer directly
+    when we can.
+    """
+    size = bitmap.rows * bitmap.pitch
+    ft_bitmap = getattr(bitmap, '_FT_Bitmap', None)
+    if ft_bitmap is None or size <= 0:
+        return bitmap.buffer
+    return bytearray(ctypes.string_at(ft_bitmap.buffer, size))
 
 class Font:
-    def __init__(self, ttf_path, height):
+    def __init__(self, ttf_path, height, face=None):
         self.version = 1
         self.ttf_path = ttf_path
         self.max_height = int(height)
-        self.face = freetype.Face(self.ttf_path)
+        self.face = face if face else freetype.Face(self.ttf_path)
         self.face.set_pixel_sizes(0, self.max_height)
+        self._charmap = None
+        self._ttf_hash = None
+        self.glyph_cache = None
+        self._glyph_set = None
         self.name = self.face.family_name + "_" + self.face.style_name
         self.wildcard_codepoint = WILDCARD_CODEPOINT
         self.number_of_glyphs = 0
@@ -61,6 +91,20 @@ class Font:
         self.regex = None
         return
 
+    def with_height(self, height):
+        """
+        Return a Font for another pixel height that shares this one's parsed
+        face and charmap. Fonts sharing a face must be rendered one at a time.
+        """
+        f = Font(self.ttf_path, height, face=self.face)
+        f._charmap = self._charmap
+        f._ttf_hash = self._ttf_hash
+        f.glyph_cache = self.glyph_cache
+        return f
+
+    def set_glyph_cache(self, cache):
+        self.glyph_cache = cache
+
     def set_tracking_adjust(self, adjust):
         self.tracking_adjust = adjust
     def set_regex_filter(self, regex_string):
@@ -74,10 +118,81 @@ class Font:
     def is_supported_glyph(self, codepoint):
         return (self.face.get_char_index(codepoint) > 0 or (codepoint == unichr(self.wildcard_codepoint)))
 
+    def charmap_codepoints(self):
+        """
+        Return, in ascending order, the codepoints in the renderable range
+        that the face's charmap has a glyph for, plus the wildcard codepoint.
+        """
+        if self._charmap is None:
+            codepoints = set([self.wildcard_codepoint])
+            charcode, gindex = self.face.get_first_char()
+            while gindex != 0:
+                if MIN_CODEPOINT <= charcode <= MAX_CODEPOINT:
+                    codepoints.add(charcode)
+                charcode, gindex = self.face.get_next_char(charcode, gindex)
+            self._charmap = sorted(codepoints)
+        return self._charmap
+
+    def exhaustive_codepoints(self):
+        """Every codepoint in the renderable range, supported or not."""
+        return xrange(MIN_CODEPOINT, MAX_CODEPOINT + 1)
+
+    def codepoints(self, candidates=None):
+        """
+        Yield the codepoints to render: the candidates (by default the
+        charmap) that pass the regex filter. The wildcard and ellipsis
+        codepoints are never filtered out.
+        """
+        if candidates is None:
+            candidates = self.charmap_codepoints()
+        for codepoint in candidates:
+            if (codepoint not in (WILDCARD_CODEPOINT, ELLIPSIS_CODEPOINT)):
+                if self.regex != None:
+                    if self.regex.match(unichr(codepoint)) == None:
+                        continue
+            yield codepoint
+
+    def ttf_hash(self):
+        if self._ttf_hash is None:
+            with open(self.ttf_path, 'rb') as f:
+                self._ttf_hash = hashlib.sha1(f.read()).hexdigest()
+        return self._ttf_hash
+
+    def glyph_set(self):
+        """This font's entry in the glyph cache, which holds all its glyphs."""
+        if self._glyph_set is None:
+            self._glyph_set = self.glyph_cache.glyph_set(self.glyph_cache.key(
+                self.ttf_hash(), self.max_height, self.tracking_adjust,
+                self.version, GLYPH_GENERATOR_VERSION))
+        return self._glyph_set
+
+    def cached_glyph_bits(self, codepoint):
+        """
+        Look codepoint up in the glyph cache. Returns (hit, glyph_bits).
+        """
+        if self.glyph_cache is None:
+            return (False, None)
+        return self.glyph_set().get(ord(codepoint))
+
+    def cache_glyph_bits(self, codepoint, glyph_bits):
+        if self.glyph_cache is not None:
+            self.glyph_set().put(ord(codepoint), glyph_bits)
+
+    def flush_glyph_cache(self):
+        if self._glyph_set is not None:
+            self._glyph_set.flush()
+
     def glyph_bits(self, codepoint):
-        self.face.load_char(codepoint)
+        hit, glyph_bits = self.cached_glyph_bits(codepoint)
+        if not hit:
+            glyph_bits = self.render_glyph_bits(codepoint)
+            self.cache_glyph_bits(codepoint, glyph_bits)
+        return glyph_bits
+
+    def render_glyph_bits(self, codepoint):
         if not self.is_supported_glyph(codepoint):
             return None
+        self.face.load_char(codepoint)
 
         # Font metrics
         bitmap = self.face.glyph.bitmap
@@ -99,16 +214,78 @@ class Font:
             ))
         glyph_header = struct.pack(glyph_structure, width, height, left, bottom, 0, 0, 0, advance)
 
-        # Iterate through the glyph's bitmap:
-        glyph_bitmap = []
-        for word in grouper(32, bitmap.buffer, 0):
-            w = 0
-            for index, px in enumerate(word):
-                value = 1 if (px > 127) else 0
-                w |= value << (index)
-            glyph_bitmap.append(struct.pack('<I', w))
+        # The glyph's bitmap is stored as unaligned rows of bits
+        return glyph_header + bitpack.pack_threshold(bitmap_coverage(bitmap))
+
+    def glyphs(self, candidates=None, jobs=1):
+        """
+        Yield (codepoint, glyph_bits) for every supported glyph to render, in
+        codepoint order. With jobs > 1 the glyphs are rasterized by a pool of
+        worker processes, each with its own FreeType face.
+        """
+        # The face may be shared with Fonts of other sizes
+        self.face.set_pixel_sizes(0, self.max_height)
+
+        codepoints = self.codepoints(candidates)
+        if jobs > 1:
+            rendered = self._rasterize_parallel(list(codepoints), jobs)
+        else:
+            rendered = ((codepoint, self.glyph_bits(unichr(codepoint))) for codepoint in codepoints)
+
+        try:
+            for codepoint, glyph_bits in rendered:
+                if glyph_bits == None:
+                    # unsupported glyph, store no data
+                    continue
+                yield codepoint, glyph_bits
+        finally:
+            self.flush_glyph_cache()
+
+    def _rasterize_parallel(self, codepoints, jobs):
+        chunks = [codepoints[i:i + RASTERIZE_CHUNK_SIZE]
+                  for i in xrange(0, len(codepoints), RASTERIZE_CHUNK_SIZE)]
+        pool = [None]
+
+        def submit(chunk):
+            # Glyphs found in the cache are filled in here, only the rest
+            # go to the workers. The pool is only started once needed.
+            cached = {}
+            missing = []
+            for codepoint in chunk:
+                hit, glyph_bits = self.cached_glyph_bits(unichr(codepoint))
+                if hit:
+                    cached[codepoint] = glyph_bits
+                else:
+                    missing.append(codepoint)
+            rendered = None
+            if missing:
+                if pool[0] is None:
+                    pool[0] = multiprocessing.Pool(jobs, _init_rasterize_worker,
+                                                   (self.ttf_path, self.max_height, self.tracking_adjust))
+                rendered = pool[0].apply_async(_rasterize_chunk, (missing,))
+            return (chunk, cached, rendered)
 
-        return glyph_header + ''.join(glyph_bitmap)
+        # Keep only a couple of chunks per worker in flight, so that when the
+        # caller stops early (e.g. at the glyph limit) little work is wasted
+        pending = collections.deque()
+        chunks = iter(chunks)
+        try:
+            for chunk in itertools.islice(chunks, 2 * jobs):
+                pending.append(submit(chunk))
+            while pending:
+                chunk, cached, rendered = pending.popleft()
+                if rendered is not None:
+                    for codepoint, glyph_bits in rendered.get():
+                        self.cache_glyph_bits(unichr(codepoint), glyph_bits)
+                        cached[codepoint] = glyph_bits
+                for next_chunk in itertools.islice(chunks, 1):
+                    pending.append(submit(next_chunk))
+                for codepoint in chunk:
+                    yield (codepoint, cached[codepoint])
+        finally:
+            if pool[0] is not None:
+                pool[0].close()
+                pool[0].join()
 
     def fontinfo_bits(self):
         return struct.pack('<BBHH',
@@ -117,7 +294,7 @@ class Font:
                            self.number_of_glyphs,
                            self.wildcard_codepoint)
 
-    def bitstring(self):
+    def bitstring(self, candidates=None, jobs=1):
         offset_table = []
         glyph_table = []
         self.number_of_glyphs = 0
@@ -127,26 +304,19 @@ class Font:
         offset = 1
         glyph_table.append(struct.pack('<I', 0))
 
-        for codepoint in xrange(MIN_CODEPOINT, MAX_CODEPOINT + 1):
-            # Hard limit on the number of glyphs in a font
-            if (self.number_of_glyphs > 255):
-                break
+        glyphs = self.glyphs(candidates, jobs)
+        try:
+            for codepoint, glyph_bits in glyphs:
+                # Hard limit on the number of glyphs in a font
+                if (self.number_of_glyphs > 255):
+                    break
 
-            character = unichr(codepoint)
-            if (codepoint not in (WILDCARD_CODEPOINT, ELLIPSIS_CODEPOINT)):
-                if self.regex != None:
-                    if self.regex.match(character) == None:
-                        continue
-
-            glyph_bits = self.glyph_bits(character)
-            if glyph_bits == None:
-                # unsupported glyph, store no data
-                continue
-
-            self.number_of_glyphs += 1
-            glyph_table.append(glyph_bits)
-            offset_table.append(struct.pack('<HH', codepoint, offset))
-            offset += len(glyph_bits) / 4
+                self.number_of_glyphs += 1
+                glyph_table.append(glyph_bits)
+                offset_table.append(struct.pack('<HH', codepoint, offset))
+                offset += len(glyph_bits) / 4
+        finally:
+            glyphs.close()
 
         return self.fontinfo_bits() + ''.join(offset_table) + ''.join(glyph_table)
 
@@ -164,19 +334,93 @@ class Font:
         f.close()
         return to_file
 
-    def convert_to_pfo(self, pfo_path=None):
+    def convert_to_pfo(self, pfo_path=None, jobs=1):
         to_file = pfo_path if pfo_path else (os.path.splitext(self.ttf_path)[0] + '.pfo')
-        with open(to_file, 'wb') as f:
-            f.write(self.bitstring())
+        # Replace rather than overwrite, the old file may be linked into a resource cache
+        with fileutil.atomic_write(to_file) as f:
+            f.write(self.bitstring(jobs=jobs))
         return to_file
 
+def render_multi(ttf_path, specs, jobs=1, cache=None):
+    """
+    Render several .pfo files from one ttf, loading the face and walking its
+    charmap only once. Each spec is a dict with 'height' and 'output' keys and
+    optional 'tracking' and 'filter' keys, as for the pfo command.
+    """
+    base = None
+    for spec in specs:
+        if base is None:
+            f = base = Font(ttf_path, spec['height'])
+            f.set_glyph_cache(cache)
+        else:
+            f = base.with_height(spec['height'])
+        if spec.get('tracking'):
+            f.set_tracking_adjust(spec['tracking'])
+        if spec.get('filter'):
+            f.set_regex_filter(spec['filter'])
+        f.convert_to_pfo(spec['output'], jobs=jobs)
+
+_worker_font = None
+
+def _init_rasterize_worker(ttf_path, height, tracking_adjust):
+    global _worker_font
+    _worker_font = Font(ttf_path, height)
+    _worker_font.set_tracking_adjust(tracking_adjust)
+
+def _rasterize_chunk(codepoints):
+    return [(codepoint, _worker_font.render_glyph_bits(unichr(codepoint))) for codepoint in codepoints]
+
+def open_glyph_cache(args):
+    if not args.glyph_cache:
+        return None
+    return glyph_cache.GlyphCache(args.glyph_cache, args.glyph_cache_size * 1024 * 1024)
+
+def close_glyph_cache(cache, args):
+    if cache is None:
+        return
+    cache.close()
+    if args.glyph_cache_stats:
+        cache.record_stats(args.glyph_cache_stats)
+
 def cmd_pfo(args):
+    cache = open_glyph_cache(args)
     f = Font(args.input_ttf, args.height)
+    f.set_glyph_cache(cache)
     if (args.tracking):
         f.set_tracking_adjust(args.tracking)
     if (args.filter):
         f.set_regex_filter(args.filter)
-    f.convert_to_pfo(args.output_pfo)
+    f.convert_to_pfo(args.output_pfo, jobs=args.jobs)
+    close_glyph_cache(cache, args)
+
+def cmd_multi(args):
+    cache = open_glyph_cache(args)
+    render_multi(args.input_ttf, [json.loads(spec) for spec in args.specs], jobs=args.jobs, cache=cache)
+    close_glyph_cache(cache, args)
+
+def cmd_benchmark(args):
+    """
+    Time charmap-driven glyph enumeration against walking every codepoint,
+    and check that both produce the same font.
+    """
+    for ttf in args.input_ttf:
+        f = Font(ttf, args.height)
+        if (args.filter):
+            f.set_regex_filter(args.filter)
+
+        start = time.time()
+        exhaustive = f.bitstring(f.exhaustive_codepoints())
+        exhaustive_time = time.time() - start
+
+        start = time.time()
+        charmap = f.bitstring()
+        charmap_time = time.time() - start
+
+        if exhaustive != charmap:
+            raise Exception("{}: charmap enumeration changed the output".format(ttf))
+        print "{0}: {1} glyphs, exhaustive {2:.3f}s, charmap {3:.3f}s ({4:.0f}x)".format(
+            os.path.basename(ttf), f.number_of_glyphs, exhaustive_time, charmap_time,
+            exhaustive_time / max(charmap_time, 1e-6))
 
 def process_all_fonts():
     font_directory = "ttf"
@@ -200,6 +444,13 @@ def process_all_fonts():
         print>>f, "#include \"{0}\"".format(h)
     f.close()
 
+def add_glyph_cache_arguments(parser):
+    parser.add_argument('--glyph-cache', metavar='DIR', help="Directory of a glyph cache to share between runs")
+    parser.add_argument('--glyph-cache-size', metavar='MB', type=int,
+                        default=glyph_cache.DEFAULT_MAX_BYTES / (1024 * 1024),
+                        help="Size above which least recently used glyphs are evicted from the cache")
+    parser.add_argument('--glyph-cache-stats', metavar='FILE', help="File to append this run's cache hit and miss counts to")
+
 def process_cmd_line_args():
     parser = argparse.ArgumentParser(description="Generate pebble-usable fonts from ttf files")
     subparsers = parser.add_subparsers(help="commands", dest='which')
@@ -208,10 +459,26 @@ def process_cmd_line_args():
     pbi_parser.add_argument('height', metavar='HEIGHT', help="Height at which to render the font")
     pbi_parser.add_argument('--tracking', type=int, help="Optional tracking adjustment of the font's horizontal advance")
     pbi_parser.add_argument('--filter', help="Regex to match the characters that should be included in the output")
+    pbi_parser.add_argument('--jobs', type=int, default=1, help="Number of worker processes to rasterize glyphs with")
     pbi_parser.add_argument('input_ttf', metavar='INPUT_TTF', help="The ttf to process")
     pbi_parser.add_argument('output_pfo', metavar='OUTPUT_PFO', help="The pfo output file")
+    add_glyph_cache_arguments(pbi_parser)
     pbi_parser.set_defaults(func=cmd_pfo)
 
+    multi_parser = subparsers.add_parser('multi', help="make several .pfo files from one ttf")
+    multi_parser.add_argument('--jobs', type=int, default=1, help="Number of worker processes to rasterize glyphs with")
+    multi_parser.add_argument('input_ttf', metavar='INPUT_TTF', help="The ttf to process")
+    multi_parser.add_argument('specs', metavar='SPEC', nargs='+',
+                              help='JSON object per output, e.g. {"height": 14, "tracking": -1, "filter": "[0-9]", "output": "a.pfo"}')
+    add_glyph_cache_arguments(multi_parser)
+    multi_parser.set_defaults(func=cmd_multi)
+
+    benchmark_parser = subparsers.add_parser('benchmark', help="time glyph enumeration strategies on some fonts")
+    benchmark_parser.add_argument('height', metavar='HEIGHT', help="Height at which to render the fonts")
+    benchmark_parser.add_argument('--filter', help="Regex to match the characters that should be included in the output")
+    benchmark_parser.add_argument('input_ttf', metavar='INPUT_TTF', nargs='+', help="The ttfs to process")
+    benchmark_parser.set_defaults(func=cmd_benchmark)
+
     args = parser.parse_args()
     args.func(args)
 
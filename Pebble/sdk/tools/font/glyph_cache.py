@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+# On-disk cache of rendered glyphs, shared between fontgen.py runs.
+#
+# Every entry holds all the cached glyphs of one font at one size and
+# tracking: a file named after the hash of its key, holding a (codepoint,
+# length) header and that many bytes for each glyph, or none for a codepoint
+# the font can't render. A run reads a font's entry once and writes it back
+# with the glyphs it rendered. Storage and eviction are cache_dir's.
+
+import errno
+import hashlib
+import os
+import struct
+
+import cache_dir
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+GLYPH_HEADER_FORMAT = '<HH'
+GLYPH_HEADER_SIZE = struct.calcsize(GLYPH_HEADER_FORMAT)
+
+class GlyphCache(cache_dir.CacheDirectory):
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        super(GlyphCache, self).__init__(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *fields):
+        return hashlib.sha1(':'.join(str(f) for f in fields)).hexdigest()
+
+    def load(self, key):
+        """The glyphs stored under key, as a dict from codepoint to glyph bits or None."""
+        path = self.entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, None)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        return decode_glyphs(data)
+
+    def save(self, key, glyphs):
+        """Add glyphs to those stored under key."""
+        # Keep the glyphs another run may have added since this one loaded
+        # them; if two runs save at once, the last one wins
+        stored = self.load(key)
+        stored.update(glyphs)
+        with self.write_entry(self.entry_path(key)) as f:
+            f.write(encode_glyphs(stored))
+
+    def glyph_set(self, key):
+        return GlyphSet(self, key)
+
+    def record_stats(self, stats_path):
+        """
+        Append this run's hit and miss counts to stats_path. Each run writes a
+        single short line, so concurrent runs can share one file.
+        """
+        fd = os.open(stats_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, '{} {}\n'.format(self.hits, self.misses))
+        finally:
+            os.close(fd)
+
+class GlyphSet(object):
+    """
+    The cached glyphs of one entry, loaded when first looked up. Glyphs
+    added with put() are written back by flush().
+    """
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.glyphs = None
+        self.added = {}
+
+    def get(self, codepoint):
+        """
+        Return (True, glyph_bits) on a hit, where glyph_bits is None for an
+        unsupported glyph, or (False, None) on a miss.
+        """
+        if self.glyphs is None:
+            self.glyphs = self.cache.load(self.key)
+        if codepoint in self.glyphs:
+            self.cache.hits += 1
+            return (True, self.glyphs[codepoint])
+        self.cache.misses += 1
+        return (False, None)
+
+    def put(self, codepoint, glyph_bits):
+        if self.glyphs is None:
+            self.glyphs = self.cache.load(self.key)
+        self.glyphs[codepoint] = glyph_bits
+        self.added[codepoint] = glyph_bits
+
+    def flush(self):
+        if self.added:
+            self.cache.save(self.key, self.added)
+            self.added = {}
+
+def encode_glyphs(glyphs):
+    return ''.join(struct.pack(GLYPH_HEADER_FORMAT, codepoint, len(glyph_bits or '')) + (glyph_bits or '')
+                   for codepoint, glyph_bits in sorted(glyphs.iteritems()))
+
+def decode_glyphs(data):
+    glyphs = {}
+    offset = 0
+    while offset + GLYPH_HEADER_SIZE <= len(data):
+        codepoint, length = struct.unpack_from(GLYPH_HEADER_FORMAT, data, offset)
+        offset += GLYPH_HEADER_SIZE
+        glyphs[codepoint] = data[offset:offset + length] or None
+        offset += length
+    return glyphs
@@ -1,16 +1,36 @@
 #!/usr/bin/env python
 
+import StringIO
 import argparse
 import os
 import struct
 
+import fileutil
 import stm32_crc
 
-def cmd_resource_header(args):
-    if (len(args.resource_pair_list) % 2) != 0:
-        raise Exception("resource_pair_list list must have an even number of entries")
-    with open(args.output_header, 'w') as output_file:
-        output_file.write("""
+def write_resource_header(output_header, version_def_name, readable_version, timestamp,
+                          resource_include, def_names, data_crc, resource_crcs,
+                          version_source=None):
+    """
+    Write the resource id header for a pack whose data chunk has CRC data_crc
+    and whose entries, in pack order, are named def_names and have CRCs
+    resource_crcs.
+
+    If version_source is given, the resource version, which carries the
+    build timestamp, is defined in that C file and the header only declares
+    it, so that a new timestamp recompiles one file rather than every file
+    including the header. Files whose contents haven't changed aren't
+    rewritten.
+    """
+    version = """const ResBankVersion {} = {{
+  .crc = {},
+  .timestamp = {},
+  .friendly_version = "{}"
+}};
+""".format(version_def_name, data_crc, timestamp, readable_version)
+
+    output_file = StringIO.StringIO()
+    output_file.write("""
 #pragma once
 
 //
@@ -22,35 +42,56 @@ def cmd_resource_header(args):
 typedef enum {{
   INVALID_RESOURCE = 0,
   DEFAULT_MENU_ICON = 0, // Friendly synonym for use in `PBL_APP_INFO()` calls
-""".format(resource_header=args.resource_include))
-        
-        for i in range(1, len(args.resource_pair_list), 2):
-            output_file.write("  RESOURCE_ID_" + args.resource_pair_list[i] + ",\n")
-            
-        with open(args.data_file, 'rb') as f:
-            crc = stm32_crc.crc32(f.read())
-
-        output_file.write("""
-}} ResourceId;
-static const ResBankVersion {} = {{
-  .crc = {},
-  .timestamp = {},
-  .friendly_version = "{}"
-}};
+""".format(resource_header=resource_include))
+
+    for def_name in def_names:
+        output_file.write("  RESOURCE_ID_" + def_name + ",\n")
 
+    output_file.write("""
+}} ResourceId;
+{}
 static const uint32_t resource_crc_table[] = {{
-""".format(args.version_def_name, crc, args.timestamp, args.readable_version))
-        
-        for i in range(0, len(args.resource_pair_list), 2):
-            with open(args.resource_pair_list[i], 'rb') as f:
-                output_file.write("  " + str(stm32_crc.crc32(f.read())) + ",\n")
-        output_file.write('};\n\n')
+""".format("extern const ResBankVersion {};\n".format(version_def_name) if version_source
+           else "static " + version))
+
+    for crc in resource_crcs:
+        output_file.write("  " + str(crc) + ",\n")
+    output_file.write('};\n\n')
+    fileutil.write_if_changed(output_header, output_file.getvalue())
+
+    if version_source:
+        fileutil.write_if_changed(version_source, """
+//
+// AUTOGENERATED BY tools/generate_resource_code.py
+// DO NOT MODIFY
+//
 
+#include "{resource_header}"
 
+{version}""".format(resource_header=resource_include, version=version))
 
-def cmd_font_key_header(args):
-    with open(args.output_header, 'w') as output_file:
-        output_file.write("""
+def cmd_resource_header(args):
+    if (len(args.resource_pair_list) % 2) != 0:
+        raise Exception("resource_pair_list list must have an even number of entries")
+
+    with open(args.data_file, 'rb') as f:
+        data_crc = stm32_crc.crc32(f.read())
+
+    resource_crcs = []
+    for i in range(0, len(args.resource_pair_list), 2):
+        with open(args.resource_pair_list[i], 'rb') as f:
+            resource_crcs.append(stm32_crc.crc32(f.read()))
+
+    write_resource_header(args.output_header, args.version_def_name, args.readable_version,
+                          args.timestamp, args.resource_include,
+                          args.resource_pair_list[1::2], data_crc, resource_crcs,
+                          args.version_source)
+
+
+
+def write_font_key_header(output_header, font_keys):
+    output_file = StringIO.StringIO()
+    output_file.write("""
 #pragma once
 
 //
@@ -59,14 +100,13 @@ def cmd_font_key_header(args):
 //
 
 """)
-        for key in args.resource_key_list:
-            output_file.write("#define FONT_KEY_{key} \"RESOURCE_ID_{key}\"\n".format(key=key))
-
+    for key in font_keys:
+        output_file.write("#define FONT_KEY_{key} \"RESOURCE_ID_{key}\"\n".format(key=key))
+    fileutil.write_if_changed(output_header, output_file.getvalue())
 
-
-def cmd_font_key_table(args):
-    with open(args.output_code_file, 'w') as output_file:
-        output_file.write("""
+def write_font_key_table(output_code_file, resource_id_header, font_key_header, font_keys):
+    output_file = StringIO.StringIO()
+    output_file.write("""
 //
 // AUTOGENERATED BY tools/generate_resource_code.py
 // DO NOT MODIFY
@@ -79,14 +119,63 @@ def cmd_font_key_table(args):
 int g_num_font_resource_keys = {num_keys};
 
 const struct PblFontResourceKey g_font_resource_keys[] = {{
-""".format(resource_id_header=args.resource_id_header,
-           font_key_header=args.font_key_header,
-           num_keys=len(args.font_key_list)))
-        for key in args.font_key_list:
-            output_file.write("  {{ FONT_KEY_{key}, RESOURCE_ID_{key} }},\n".format(key=key))
-        output_file.write("};\n")
-                              
-                          
+""".format(resource_id_header=resource_id_header,
+           font_key_header=font_key_header,
+           num_keys=len(font_keys)))
+    for key in font_keys:
+        output_file.write("  {{ FONT_KEY_{key}, RESOURCE_ID_{key} }},\n".format(key=key))
+    output_file.write("};\n")
+    fileutil.write_if_changed(output_code_file, output_file.getvalue())
+
+def generate_all(metadata, def_names, output_header, version_def_name, resource_include,
+                 font_key_header=None, font_key_table=None, font_key_include=None, font_keys=(),
+                 version_source=None):
+    """
+    Write the resource id header, and the font key header and table if
+    their paths are given, from a pack's metadata: a dict with its data
+    chunk 'crc', 'timestamp', 'readable_version' and 'entries' (whose crc
+    attributes are the table's CRCs), as returned by pbpack.build_pack().
+    def_names name the entries, in pack order.
+    """
+    write_resource_header(output_header, version_def_name, metadata['readable_version'],
+                          metadata['timestamp'], resource_include, def_names,
+                          metadata['crc'], [e.crc for e in metadata['entries']],
+                          version_source)
+    if font_key_header:
+        write_font_key_header(font_key_header, font_keys)
+    if font_key_table:
+        write_font_key_table(font_key_table, resource_include, font_key_include or font_key_header,
+                             font_keys)
+
+def cmd_font_key_header(args):
+    write_font_key_header(args.output_header, args.resource_key_list)
+
+
+
+def cmd_font_key_table(args):
+    write_font_key_table(args.output_code_file, args.resource_id_header, args.font_key_header,
+                         args.font_key_list)
+
+def cmd_generate_all(args):
+    # pbpack uses this module to write the code as it builds a pack
+    import pbpack
+
+    with pbpack.PbPack(args.pack_file) as pack:
+        metadata = {
+            'crc': pack.crc,
+            'timestamp': pack.timestamp,
+            'readable_version': pack.readable_version,
+            'entries': list(pack.entries()),
+            }
+    if len(metadata['entries']) != len(args.def_name_list):
+        raise Exception("{} has {} resources, but {} names were given".format(
+            args.pack_file, len(metadata['entries']), len(args.def_name_list)))
+
+    generate_all(metadata, args.def_name_list, args.output_header, args.version_def_name,
+                 args.resource_include, args.font_key_header, args.font_key_table,
+                 args.font_key_include, args.font_keys or [], args.version_source)
+
+
 
 def main():
     parser = argparse.ArgumentParser(description="Generate the needed code to use resources")
@@ -100,6 +189,7 @@ def main():
     resource_header_parser.add_argument('resource_include', metavar="RESOURCE_INCLUDE", help="Include path to insert into the output file")
     resource_header_parser.add_argument('data_file', metavar="DATA_FILE", help="The data chunk file")
     resource_header_parser.add_argument('resource_pair_list', metavar="RESOURCE_PAIR_LIST", help="list of pairs of <filename> <defname>", nargs="*")
+    resource_header_parser.add_argument('--version-source', metavar="VERSION_SOURCE", help="Define the resource version in this C file instead of the header")
     resource_header_parser.set_defaults(func=cmd_resource_header)
 
     font_key_header_parser = subparsers.add_parser('font_key_header', help="Make the font key header file")
@@ -113,6 +203,19 @@ def main():
     font_table_header_parser.add_argument('font_key_header', metavar="font_key_header", help="header to include to get the font keys")
     font_table_header_parser.add_argument('font_key_list', metavar="FONT_KEY_LIST", help="List of resource def_names of fonts", nargs="*")
     font_table_header_parser.set_defaults(func=cmd_font_key_table)
+
+    generate_all_parser = subparsers.add_parser('generate_all', help="make the resource id header, and optionally the font key header and table, from a built pack")
+    generate_all_parser.add_argument('pack_file', metavar="PACK_FILE", help="The built .pbpack to take the CRCs, timestamp and version from")
+    generate_all_parser.add_argument('output_header', metavar="OUTPUT_HEADER", help="Resource id header to write")
+    generate_all_parser.add_argument('version_def_name', metavar="VERSION_DEF_NAME", help="Name of the resource version")
+    generate_all_parser.add_argument('resource_include', metavar="RESOURCE_INCLUDE", help="Include path to insert into the output file")
+    generate_all_parser.add_argument('def_name_list', metavar="DEF_NAME_LIST", help="defnames of the pack's resources, in pack order", nargs="*")
+    generate_all_parser.add_argument('--font-key-header', metavar="FONT_KEY_HEADER", help="Font key header to write")
+    generate_all_parser.add_argument('--font-key-table', metavar="FONT_KEY_TABLE", help="Font key table C file to write")
+    generate_all_parser.add_argument('--font-key-include', metavar="FONT_KEY_INCLUDE", help="Include path of the font key header, for the font key table")
+    generate_all_parser.add_argument('--font-keys', metavar="FONT_KEY", help="defnames of the fonts", nargs="*")
+    generate_all_parser.add_argument('--version-source', metavar="VERSION_SOURCE", help="Define the resource version in this C file instead of the header")
+    generate_all_parser.set_defaults(func=cmd_generate_all)
     
     args = parser.parse_args()
     args.func(args)
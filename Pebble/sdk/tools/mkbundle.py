@@ -2,18 +2,57 @@
 
 from __future__ import print_function
 
+import StringIO
+import collections
+import itertools
 import os
 import sys
 import zipfile
+import zlib
 import argparse
 import json
 import time
 import stm32_crc
 import socket
 import pprint
+import multiprocessing
+import pbpack
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
 
 MANIFEST_VERSION = 1
 BUNDLE_PREFIX = 'bundle'
+CRC_CHUNK_SIZE = 64 * 1024
+
+# zlib levels for the bundle's members; 0 stores them uncompressed, as
+# bundles always were
+STORE_LEVEL = 0
+MAX_COMPRESS_LEVEL = 9
+
+BOARDS = ['bigboard', 'ev1', 'ev2']
+FIRMWARE_TYPES = ['normal', 'recovery']
+
+# The manifest sections that name a member of the bundle
+BUNDLE_SECTIONS = ('application', 'firmware', 'resources')
+BUNDLE_EXTENSIONS = ('.pbw', '.pbz')
+
+# Resource map entries that become more than one file of the pack
+PACK_FILES_PER_RESOURCE = {'png-trans': 2}
+
+# The pack's manifest keeps this many bytes of the friendly version
+PACK_VERSION_LENGTH = 16
+
+# Batch job lists with these extensions are YAML, anything else JSON
+YAML_EXTENSIONS = ('.yaml', '.yml')
+
+# The fields of a batch job that hold paths, relative to the job list
+BATCH_PATHS = ('watchapp', 'firmware', 'resources', 'resource_map', 'outfile')
+
+# The arguments naming files that go into the bundle
+BUNDLE_FILE_ARGS = ('watchapp', 'firmware', 'resources')
 
 class MissingFileException(Exception):
     def __init__(self, filename):
@@ -24,70 +63,117 @@ def flen(path):
     return statinfo.st_size
 
 def stm32crc(path):
-    with open(path, 'r+b') as f:
-        binfile = f.read()
-        return stm32_crc.crc32(binfile) & 0xFFFFFFFF
+    crc = stm32_crc.Crc32Stm()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CRC_CHUNK_SIZE), ''):
+            crc.update(chunk)
+    return crc.digest() & 0xFFFFFFFF
 
 def check_paths(*args):
     for path in args:
         if not os.path.exists(path):
-            pprint.pprint(path)
+            pprint.pprint(path, stream=sys.stderr)
             raise MissingFileException(path)
 
+_hostname = None
+
+def hostname():
+    """socket.gethostname(), looked up once per process."""
+    global _hostname
+    if _hostname is None:
+        _hostname = socket.gethostname()
+    return _hostname
+
+def crc_cache_key(path, st=None):
+    """The key of the file at path, with os.stat() result st, in a PebbleBundle's crc_cache."""
+    st = st or os.stat(path)
+    return (os.path.realpath(path), st.st_size, st.st_mtime)
+
+def data_chunks(data):
+    """The contents of a str, bytearray, buffer or memoryview in CRC_CHUNK_SIZE pieces."""
+    if isinstance(data, memoryview):
+        return (data[offset:offset + CRC_CHUNK_SIZE].tobytes()
+                for offset in xrange(0, len(data), CRC_CHUNK_SIZE))
+    return (buffer(data, offset, CRC_CHUNK_SIZE)[:]
+            for offset in xrange(0, len(data), CRC_CHUNK_SIZE))
+
 class PebbleBundle(object):
     def __init__(self):
         self.generated_at = int(time.time())
         self.bundle_manifest = {
             'manifestVersion' : MANIFEST_VERSION,
             'generatedAt' : self.generated_at,
-            'generatedBy' : socket.gethostname(),
+            'generatedBy' : hostname(),
             'debug' : {},
             }
+        # (manifest section, member name, path, data); one of path and data is None
         self.bundle_files = []
+        # Worker processes can't start pools of their own, so those bundling
+        # in one turn this off
+        self.parallel_crc = True
+        # Optionally a dict from crc_cache_key() to STM32 CRC, shared between
+        # bundles so that a file in several of them is only CRCed once
+        self.crc_cache = None
         self.has_firmware = False
         self.has_watchapp = False
         self.has_resources = False
 
     def add_firmware(self, firmware_path, firmware_type, firmware_timestamp, firmware_hwrev):
+        check_paths(firmware_path)
+        return self._add_firmware(os.path.basename(firmware_path), firmware_path, None,
+                                  firmware_type, firmware_timestamp, firmware_hwrev)
+
+    def add_firmware_data(self, name, firmware_data, firmware_type, firmware_timestamp, firmware_hwrev):
+        """add_firmware() for a firmware in memory, as a str or buffer object, named name in the bundle."""
+        return self._add_firmware(name, None, firmware_data,
+                                  firmware_type, firmware_timestamp, firmware_hwrev)
+
+    def _add_firmware(self, name, path, data, firmware_type, firmware_timestamp, firmware_hwrev):
         if self.has_firmware:
             raise Exception("Added multiple firmwares to a single bundle")
 
         if self.has_watchapp:
             raise Exception("Cannot add firmware and watchapp to a single bundle")
 
-        if firmware_type != 'normal' and firmware_type != 'recovery':
+        if firmware_type not in FIRMWARE_TYPES:
             raise Exception("Invalid firmware type!")
 
-        check_paths(firmware_path)
         self.type = 'firmware'
-        self.bundle_files.append(firmware_path)
+        self.bundle_files.append(('firmware', name, path, data))
         self.bundle_manifest['firmware'] = {
-            'name' : os.path.basename(firmware_path),
+            'name' : name,
             'type' : firmware_type,
             'timestamp' : firmware_timestamp,
             'hwrev' : firmware_hwrev,
-            'size' : flen(firmware_path),
-            'crc' : stm32crc(firmware_path),
             }
         self.has_firmware = True
         return True
 
     def add_resources(self, resource_path, resource_map_path, resources_timestamp):
-        if self.has_resources:
-            raise Exception("Added multiple resource packs to a single bundle")
-
         check_paths(resource_path, resource_map_path)
-        self.bundle_files.append(resource_path)
-
         with open(resource_map_path) as fm:
             resource_map = json.load(fm)
+        return self._add_resources(os.path.basename(resource_path), resource_path, None,
+                                   resource_map, resources_timestamp)
+
+    def add_resources_data(self, name, resource_data, resource_map, resources_timestamp):
+        """
+        add_resources() for a resource pack in memory, named name in the
+        bundle. resource_map is the map itself, either parsed or as JSON.
+        """
+        if isinstance(resource_map, basestring):
+            resource_map = json.loads(resource_map)
+        return self._add_resources(name, None, resource_data, resource_map, resources_timestamp)
+
+    def _add_resources(self, name, path, data, resource_map, resources_timestamp):
+        if self.has_resources:
+            raise Exception("Added multiple resource packs to a single bundle")
 
+        self.bundle_files.append(('resources', name, path, data))
         self.bundle_manifest['resources'] = {
-            'name' : os.path.basename(resource_path),
+            'name' : name,
             'friendlyVersion' : resource_map['friendlyVersion'],
             'timestamp' : resources_timestamp,
-            'size' : flen(resource_path),
-            'crc' : stm32crc(resource_path),
             }
         self.bundle_manifest['debug']['resourceMap'] = resource_map
 
@@ -95,46 +181,167 @@ class PebbleBundle(object):
         return True
 
     def add_watchapp(self, watchapp_path, app_timestamp, app_req_fw_version):
+        check_paths(watchapp_path)
+        return self._add_watchapp(os.path.basename(watchapp_path), watchapp_path, None,
+                                  app_timestamp, app_req_fw_version)
+
+    def add_watchapp_data(self, name, watchapp_data, app_timestamp, app_req_fw_version):
+        """add_watchapp() for an app in memory, as a str or buffer object, named name in the bundle."""
+        return self._add_watchapp(name, None, watchapp_data, app_timestamp, app_req_fw_version)
+
+    def _add_watchapp(self, name, path, data, app_timestamp, app_req_fw_version):
         if self.has_watchapp:
             raise Exception("Added multiple apps to a single bundle")
 
         if self.has_firmware:
             raise Exception("Cannot add watchapp and firmware to a single bundle")
-        
-        check_paths(watchapp_path)
+
         self.type = 'application'
-        self.bundle_files.append(watchapp_path)
+        self.bundle_files.append(('application', name, path, data))
         self.bundle_manifest['application'] = {
-            'name' : os.path.basename(watchapp_path),
+            'name' : name,
             'timestamp': app_timestamp,
             'reqFwVer': app_req_fw_version,
-            'size': flen(watchapp_path),
-            'crc': stm32crc(watchapp_path)
             }
         self.has_watchapp = True
         return True
 
-    def write(self, out_path = None, verbose = False):
+    def write(self, out_path = None, verbose = False, compress_level = STORE_LEVEL, store_resources = False):
+        """
+        Write the bundle to out_path. Every file is read once, in chunks that
+        feed its CRC and size for the manifest and its member of the zip at
+        the same time, and the manifest is written last. Members are deflated
+        at compress_level (1-9) or, at 0, stored; store_resources stores the
+        resource pack regardless, for packs whose resources are compressed
+        already.
+        """
         if not (self.has_firmware or self.has_watchapp):
             raise Exception("Bundle must contain either a firmware or watchapp")
 
-        self.bundle_manifest['type'] = self.type
-
         if not out_path:
             out_path = 'pebble-{}-{:d}.pbz'.format(self.type, self.generated_at)
 
         if verbose:
-            pprint.pprint(self.bundle_manifest)
             print('writing bundle to {}'.format(out_path))
 
-        with zipfile.ZipFile(out_path, 'w') as z:
-            for f in self.bundle_files:
-                z.write(f, os.path.basename(f))
-            z.writestr('manifest.json', json.dumps(self.bundle_manifest))
+        with open(out_path, 'wb') as f:
+            self.write_to(f, compress_level, store_resources)
 
         if verbose:
+            pprint.pprint(self.bundle_manifest)
             print('done!')
 
+    def to_bytes(self, compress_level = STORE_LEVEL, store_resources = False):
+        """The bundle as a str, built without touching the disk."""
+        out = StringIO.StringIO()
+        self.write_to(out, compress_level, store_resources)
+        return out.getvalue()
+
+    def write_to(self, fileobj, compress_level = STORE_LEVEL, store_resources = False):
+        """Write the bundle, as write() does, to fileobj, which must be seekable."""
+        if not (self.has_firmware or self.has_watchapp):
+            raise Exception("Bundle must contain either a firmware or watchapp")
+
+        self.bundle_manifest['type'] = self.type
+
+        with zipfile.ZipFile(fileobj, 'w') as z:
+            for section, name, path, data in self.bundle_files:
+                level = STORE_LEVEL if (section == 'resources' and store_resources) else compress_level
+                if path is not None:
+                    st = os.stat(path)
+                    zinfo = zipfile.ZipInfo(name, time.localtime(st.st_mtime)[0:6])
+                    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+                    size = st.st_size
+                else:
+                    zinfo = zipfile.ZipInfo(name, time.localtime(self.generated_at)[0:6])
+                    zinfo.external_attr = 0644 << 16
+                    size = len(data)
+
+                cache_key = known_crc = None
+                if path is not None and self.crc_cache is not None:
+                    cache_key = crc_cache_key(path, st)
+                    known_crc = self.crc_cache.get(cache_key)
+
+                if known_crc is not None:
+                    crc = None
+                # The firmware is big enough to be worth CRCing on every core
+                elif self.parallel_crc and section == 'firmware' and size >= stm32_crc.PARALLEL_MIN_SIZE:
+                    crc = stm32_crc.ParallelCrc32Stm()
+                else:
+                    crc = stm32_crc.Crc32Stm()
+                try:
+                    if path is not None:
+                        with open(path, 'rb') as f:
+                            size = write_member(z, zinfo, iter(lambda: f.read(CRC_CHUNK_SIZE), ''), level, crc)
+                    else:
+                        size = write_member(z, zinfo, data_chunks(data), level, crc)
+                    if crc is not None:
+                        known_crc = crc.digest() & 0xFFFFFFFF
+                        if cache_key is not None:
+                            self.crc_cache[cache_key] = known_crc
+                    self.bundle_manifest[section]['size'] = size
+                    self.bundle_manifest[section]['crc'] = known_crc
+                finally:
+                    if isinstance(crc, stm32_crc.ParallelCrc32Stm):
+                        crc.close()
+
+            z.writestr('manifest.json', json.dumps(self.bundle_manifest))
+
+def write_member(z, zinfo, chunks, level, crc=None):
+    """
+    Add a member described by zinfo to the ZipFile z, taking its contents
+    from the iterable chunks in a single pass, deflated at level or stored
+    at STORE_LEVEL. Each chunk is also fed to crc, if given. Returns the
+    member's size.
+
+    Python 2's zipfile can only add a member it can read twice, so this
+    writes the local header, streams the data after it and then rewrites the
+    header with the CRC and sizes, as ZipFile.write() does for files.
+
+    That means going through ZipFile's internals (_writecheck, _didModify,
+    fp, filelist and NameToInfo) as ZipFile.write() does in Python 2.7.18,
+    the version this was checked against. Run mkbundle.py --self-test to
+    check another interpreter's zipfile.
+    """
+    zinfo.compress_type = zipfile.ZIP_STORED if level == STORE_LEVEL else zipfile.ZIP_DEFLATED
+    zinfo.flag_bits = 0x00
+    zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+    zinfo.header_offset = z.fp.tell()
+    z._writecheck(zinfo)
+    z._didModify = True
+    z.fp.write(zinfo.FileHeader(False))
+
+    cmpr = zlib.compressobj(level, zlib.DEFLATED, -15) if level != STORE_LEVEL else None
+    zip_crc = 0
+    file_size = 0
+    compress_size = 0
+    for chunk in chunks:
+        if crc is not None:
+            crc.update(chunk)
+        file_size += len(chunk)
+        zip_crc = zlib.crc32(chunk, zip_crc) & 0xffffffff
+        if cmpr:
+            chunk = cmpr.compress(chunk)
+        compress_size += len(chunk)
+        z.fp.write(chunk)
+    if cmpr:
+        chunk = cmpr.flush()
+        compress_size += len(chunk)
+        z.fp.write(chunk)
+    if max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+        raise zipfile.LargeZipFile("{} is too large for a bundle".format(zinfo.filename))
+
+    zinfo.file_size = file_size
+    zinfo.compress_size = compress_size
+    zinfo.CRC = zip_crc
+    position = z.fp.tell()
+    z.fp.seek(zinfo.header_offset, 0)
+    z.fp.write(zinfo.FileHeader(False))
+    z.fp.seek(position, 0)
+    z.filelist.append(zinfo)
+    z.NameToInfo[zinfo.filename] = zinfo
+    return file_size
+
 def check_required_args(opts, *args):
     options = vars(opts)
     for required_arg in args:
@@ -144,42 +351,507 @@ def check_required_args(opts, *args):
         except KeyError:
             raise Exception("Missing argument {}".format(required_arg))
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Create a firmware+resources bundle for a Pebble.')
+def add_bundle_arguments(parser):
+    """Add the arguments describing a bundle's contents and format to parser."""
     parser.add_argument('--firmware', help='path to the firmware .bin')
     parser.add_argument('--firmware-timestamp', help='the (git) timestamp of the firmware', type=int)
     parser.add_argument('--watchapp', help='path to the watchapp .bin')
     parser.add_argument('--watchapp-timestamp', help='the (git) timestamp of the app', type=int)
     parser.add_argument('--req-fw', help='the required firmware to run the app', type=int)
-    parser.add_argument('--board', help='the board for which the firmware was built', choices = ['bigboard', 'ev1', 'ev2'])
-    parser.add_argument('--firmware-type', help='the type of firmware included in the bundle', choices = ['normal', 'recovery'])
+    parser.add_argument('--board', help='the board for which the firmware was built', choices = BOARDS)
+    parser.add_argument('--firmware-type', help='the type of firmware included in the bundle', choices = FIRMWARE_TYPES)
     parser.add_argument('--resources', help='path to the generated resource pack')
     parser.add_argument('--resource-map', help='path to the resource map')
     parser.add_argument('--resources-timestamp', help='the (git) timestamp of the resource pack', type=int)
-    parser.add_argument("-v", "--verbose", help="print additional output", action="store_true")
-    parser.add_argument("-o", "--outfile", help="path to the output file")
-    args = parser.parse_args()
-
-    if len(sys.argv) < 2:
-        parser.print_help()
-        sys.exit(1)
-
+    parser.add_argument("-z", "--compress-level", help="zlib level to deflate the bundle's files at, 1-9, or 0 to store them (the default)", type=int, choices=range(STORE_LEVEL, MAX_COMPRESS_LEVEL + 1), default=STORE_LEVEL)
+    parser.add_argument("--store-resources", help="store the resource pack uncompressed whatever the compression level, e.g. when its resources are compressed already", action="store_true")
+
+def bundle_from_args(args, data=None):
+    """
+    A PebbleBundle of the files named by args, parsed from the arguments of
+    add_bundle_arguments(). data optionally maps 'watchapp', 'firmware',
+    'resources' and 'resource_map' to their contents in memory, which are
+    used instead of reading those files.
+    """
+    data = data or {}
     b = PebbleBundle()
 
     if args.watchapp:
         check_required_args(args, 'watchapp_timestamp', 'req_fw')
         watchapp_path = os.path.expanduser(args.watchapp)
-        b.add_watchapp(watchapp_path, args.watchapp_timestamp, args.req_fw)
+        if 'watchapp' in data:
+            b.add_watchapp_data(os.path.basename(watchapp_path), data['watchapp'],
+                                args.watchapp_timestamp, args.req_fw)
+        else:
+            b.add_watchapp(watchapp_path, args.watchapp_timestamp, args.req_fw)
 
     if args.firmware:
         check_required_args(args, 'firmware_timestamp', 'board', 'firmware_type')
         firmware_path = os.path.expanduser(args.firmware)
-        b.add_firmware(firmware_path, args.firmware_type, args.firmware_timestamp, args.board)
+        if 'firmware' in data:
+            b.add_firmware_data(os.path.basename(firmware_path), data['firmware'],
+                                args.firmware_type, args.firmware_timestamp, args.board)
+        else:
+            b.add_firmware(firmware_path, args.firmware_type, args.firmware_timestamp, args.board)
 
     if args.resources:
         check_required_args(args, 'resource_map', 'resources_timestamp')
         resource_path = os.path.expanduser(args.resources)
         resmap_path = os.path.expanduser(args.resource_map)
-        b.add_resources(resource_path, resmap_path, args.resources_timestamp)
+        if 'resources' in data:
+            if 'resource_map' in data:
+                resource_map = data['resource_map']
+            else:
+                with open(resmap_path) as fm:
+                    resource_map = json.load(fm)
+            b.add_resources_data(os.path.basename(resource_path), data['resources'],
+                                 resource_map, args.resources_timestamp)
+        else:
+            b.add_resources(resource_path, resmap_path, args.resources_timestamp)
+
+    return b
+
+def read_bundle_files(args):
+    """The contents of the files args names, as the data for bundle_from_args()."""
+    data = {}
+    for key in ('watchapp', 'firmware', 'resources', 'resource_map'):
+        path = getattr(args, key)
+        if path:
+            with open(os.path.expanduser(path), 'rb') as f:
+                data[key] = f.read()
+    return data
+
+def verify_bundle(path, parallel_crc=False):
+    """
+    Check the bundle at path against its manifest.json: every member's size
+    and STM32 CRC, recomputed as it is streamed out of the zip once, without
+    extracting it, and the resource pack against debug.resourceMap. Returns
+    a list of problems, empty for a good bundle. parallel_crc CRCs a large
+    firmware on every core, as PebbleBundle does.
+    """
+    try:
+        z = zipfile.ZipFile(path)
+    except (IOError, zipfile.BadZipfile) as e:
+        return ["can't open bundle: {}".format(e)]
+
+    problems = []
+    with z:
+        try:
+            manifest = json.loads(z.read('manifest.json'))
+        except KeyError:
+            return ["no manifest.json"]
+        except (ValueError, zipfile.BadZipfile, zlib.error) as e:
+            return ["bad manifest.json: {}".format(e)]
+
+        if 'application' not in manifest and 'firmware' not in manifest:
+            problems.append("manifest has neither an application nor a firmware")
+
+        for section in BUNDLE_SECTIONS:
+            if section not in manifest:
+                continue
+            info = manifest[section]
+            name = info.get('name')
+            if name not in z.NameToInfo:
+                problems.append("{}: no member {}".format(section, name))
+                continue
+
+            # The resource pack is small, and checked against the map below
+            keep = section == 'resources'
+            chunks = []
+            if parallel_crc and section == 'firmware' and \
+                    z.getinfo(name).file_size >= stm32_crc.PARALLEL_MIN_SIZE:
+                crc = stm32_crc.ParallelCrc32Stm()
+            else:
+                crc = stm32_crc.Crc32Stm()
+            size = 0
+            try:
+                with z.open(name) as f:
+                    for chunk in iter(lambda: f.read(CRC_CHUNK_SIZE), ''):
+                        crc.update(chunk)
+                        size += len(chunk)
+                        if keep:
+                            chunks.append(chunk)
+                crc = crc.digest() & 0xFFFFFFFF
+            except (zipfile.BadZipfile, zlib.error) as e:
+                problems.append("{}: can't read {}: {}".format(section, name, e))
+                continue
+            finally:
+                if isinstance(crc, stm32_crc.ParallelCrc32Stm):
+                    crc.close()
+
+            if size != info.get('size'):
+                problems.append("{}: {} is {} bytes, the manifest says {}".format(
+                    section, name, size, info.get('size')))
+            if crc != info.get('crc'):
+                problems.append("{}: {} has CRC 0x{:08x}, the manifest says {}".format(
+                    section, name, crc, info.get('crc')))
+            if keep:
+                problems.extend(verify_resources(name, ''.join(chunks), info,
+                                                 manifest.get('debug', {}).get('resourceMap')))
+    return problems
+
+def verify_resources(name, data, info, resource_map):
+    """Check the resource pack data, named name, against its manifest section info and resource_map."""
+    if resource_map is None:
+        return ["resources: no debug.resourceMap"]
+
+    problems = []
+    friendly_version = resource_map.get('friendlyVersion')
+    if info.get('friendlyVersion') != friendly_version:
+        problems.append("resources: friendlyVersion {!r}, the resource map's is {!r}".format(
+            info.get('friendlyVersion'), friendly_version))
+
+    expected_files = sum(PACK_FILES_PER_RESOURCE.get(entry.get('type'), 1)
+                         for entry in resource_map.get('media', []))
+    try:
+        with pbpack.PbPack(name, data) as pack:
+            if friendly_version is not None and \
+                    pack.readable_version != friendly_version.encode('utf8')[:PACK_VERSION_LENGTH]:
+                problems.append("resources: {} has version {!r}, the resource map's is {!r}".format(
+                    name, pack.readable_version, friendly_version))
+            if pack.num_files != expected_files:
+                problems.append("resources: {} has {} files, the resource map has {}".format(
+                    name, pack.num_files, expected_files))
+            problems.extend("resources: {}: {}".format(name, problem) for problem in pack.verify())
+    except pbpack.PbPackError as e:
+        problems.append("resources: {}".format(e))
+    return problems
+
+def _verify_job(path, parallel_crc=False):
+    start = time.time()
+    try:
+        problems = verify_bundle(path, parallel_crc)
+    except Exception as e:
+        # Reported like any other problem rather than stopping the whole run
+        problems = ["{}: {}".format(type(e).__name__, e)]
+    return dict(bundle=path, ok=not problems, problems=problems,
+                seconds=round(time.time() - start, 3))
+
+def find_bundles(paths):
+    """paths, with each directory replaced by the bundles in it, sorted."""
+    bundles = []
+    for path in paths:
+        if os.path.isdir(path):
+            bundles.extend(sorted(os.path.join(path, filename) for filename in os.listdir(path)
+                                  if filename.endswith(BUNDLE_EXTENSIONS)))
+        else:
+            bundles.append(path)
+    return bundles
+
+def verify_bundles(paths, jobs=None):
+    """
+    Verify the bundles in paths, bundles or directories of them, on jobs
+    processes (one per core by default). Yields a dict for each bundle,
+    with its path, whether it's ok, its problems and the seconds taken, in
+    the order they finish.
+    """
+    bundles = find_bundles(paths)
+    if len(bundles) <= 1 or jobs == 1:
+        # Spread a lone bundle's firmware CRC over the cores instead
+        for path in bundles:
+            yield _verify_job(path, jobs != 1)
+        return
+
+    pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(), len(bundles)))
+    try:
+        for result in pool.imap_unordered(_verify_job, bundles):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def run_verify(paths, jobs=None):
+    """Print a JSON line for each bundle verified. Returns whether they all were good."""
+    checked = failed = 0
+    start = time.time()
+    for result in verify_bundles(paths, jobs):
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+        checked += 1
+        failed += not result['ok']
+    print('verified {} bundles in {:.2f}s: {} bad'.format(checked, time.time() - start, failed),
+          file=sys.stderr)
+    return not failed
+
+class BatchEntryParser(argparse.ArgumentParser):
+    """An ArgumentParser for batch entries, raising on a bad one instead of exiting."""
+
+    def __init__(self):
+        super(BatchEntryParser, self).__init__(prog='batch entry', add_help=False)
+        add_bundle_arguments(self)
+        # Bundles built at the same time would all get the same default name
+        self.add_argument('--outfile', required=True)
+
+    def error(self, message):
+        raise Exception(message)
+
+def batch_entry_args(parser, entry, base):
+    """
+    Parse a batch entry, mapping flag names to values, as the command line
+    --name=value for each, so that it gets the command line's checks.
+    Relative paths are taken from base.
+    """
+    if not isinstance(entry, dict):
+        raise Exception("expected a mapping of flags to values")
+    argv = []
+    for key, value in sorted(entry.iteritems()):
+        flag = '--' + str(key).replace('_', '-')
+        if isinstance(value, bool):
+            # Only the store_true flags take no value
+            if value:
+                argv.append(flag)
+        elif isinstance(value, (int, long, float, basestring)):
+            if isinstance(value, unicode):
+                value = value.encode('utf8')
+            argv.append('{}={}'.format(flag, value))
+        elif value is not None:
+            raise Exception("{} isn't a string or number".format(key))
+    args = parser.parse_args(argv)
+    for key in BATCH_PATHS:
+        if getattr(args, key):
+            setattr(args, key, os.path.normpath(os.path.join(base, os.path.expanduser(getattr(args, key)))))
+    return args
+
+def load_batch(path):
+    """
+    The jobs in the batch file at path, a JSON (or, given PyYAML, YAML)
+    list with an entry per bundle. An entry maps the names of this script's
+    flags, e.g. watchapp-timestamp, and outfile to their values, checked as
+    on the command line; relative paths are taken from the batch file's
+    directory. Returns the good entries as argparse.Namespace objects like
+    the command line's, and a result, as from build_batch(), for each bad one.
+    """
+    with open(path) as f:
+        if path.endswith(YAML_EXTENSIONS):
+            if yaml is None:
+                raise Exception("PyYAML is needed to read {}".format(path))
+            entries = yaml.safe_load(f)
+        else:
+            entries = json.load(f)
+    if not isinstance(entries, list):
+        raise Exception("{}: expected a list of bundles".format(path))
+
+    parser = BatchEntryParser()
+    base = os.path.dirname(os.path.abspath(path))
+    batch = []
+    errors = []
+    for i, entry in enumerate(entries):
+        try:
+            batch.append(batch_entry_args(parser, entry, base))
+        except Exception as e:
+            outfile = entry.get('outfile') if isinstance(entry, dict) else None
+            errors.append(dict(bundle=i, outfile=outfile, ok=False,
+                               error="bad batch entry: {}".format(e)))
+    return batch, errors
+
+def shared_bundle_files(batch):
+    """The files that more than one of the bundles in batch contain."""
+    counts = collections.Counter()
+    for args in batch:
+        for key in BUNDLE_FILE_ARGS:
+            path = getattr(args, key)
+            if path:
+                counts[os.path.realpath(path)] += 1
+    return sorted(path for path, count in counts.iteritems() if count > 1)
+
+def _crc_job(path):
+    try:
+        return crc_cache_key(path), stm32crc(path)
+    except (IOError, OSError):
+        # Left for the bundles containing it to report
+        return None
+
+def _batch_job(job):
+    """Build one bundle of a batch. job is (args, crc_cache, parallel_crc)."""
+    args, crc_cache, parallel_crc = job
+    start = time.time()
+    error = None
+    try:
+        b = bundle_from_args(args)
+        b.crc_cache = crc_cache
+        b.parallel_crc = parallel_crc
+        b.write(args.outfile, False, args.compress_level, args.store_resources)
+    except MissingFileException as e:
+        error = "missing file {}".format(e.filename)
+    except Exception as e:
+        # Not every exception survives the trip back from a worker, its
+        # description does
+        error = "{}: {}".format(type(e).__name__, e)
+    result = dict(outfile=args.outfile, ok=error is None, seconds=round(time.time() - start, 3))
+    if error:
+        result['error'] = error
+    else:
+        result['size'] = flen(args.outfile)
+    return result
+
+def build_batch(batch, jobs=None):
+    """
+    Build the bundles in batch, a list from load_batch(), on jobs processes
+    (one per core by default). Yields a dict for each bundle, with its
+    outfile, whether it was built, its size or error and the seconds taken,
+    in the order they finish. Files in several bundles are only CRCed once.
+    """
+    crc_cache = {}
+    if len(batch) <= 1 or jobs == 1:
+        # Each bundle adds its files' CRCs to crc_cache for the next
+        for args in batch:
+            yield _batch_job((args, crc_cache, jobs != 1))
+        return
+
+    pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(), len(batch)))
+    try:
+        # The workers each get a copy of crc_cache, so the shared files are
+        # CRCed before any bundle is built
+        for entry in pool.imap_unordered(_crc_job, shared_bundle_files(batch)):
+            if entry is not None:
+                key, crc = entry
+                crc_cache[key] = crc
+        for result in pool.imap_unordered(_batch_job, [(args, crc_cache, False) for args in batch]):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+def run_batch(batch_path, jobs=None):
+    """Build the bundles in a batch file, printing a JSON line for each. Returns whether they all were built."""
+    built = failed = total_size = 0
+    start = time.time()
+    batch, errors = load_batch(batch_path)
+    for result in itertools.chain(errors, build_batch(batch, jobs)):
+        print(json.dumps(result, sort_keys=True))
+        sys.stdout.flush()
+        if result['ok']:
+            built += 1
+            total_size += result['size']
+        else:
+            failed += 1
+    print('built {} bundles ({} bytes) in {:.2f}s: {} failed'.format(
+        built, total_size, time.time() - start, failed), file=sys.stderr)
+    return not failed
+
+def _self_test():
+    """Check that bundles streamed by write_member() read back through zipfile."""
+    import random
+    import shutil
+    import tempfile
+
+    rand = random.Random(0)
+    directory = tempfile.mkdtemp()
+    try:
+        def make_file(name, length):
+            path = os.path.join(directory, name)
+            with open(path, 'wb') as f:
+                # Runs of a repeated byte, so that deflating has work to do
+                f.write(''.join(chr(rand.randrange(256)) * rand.randrange(1, 64)
+                                for i in xrange(length / 32))[:length])
+            return path
+
+        firmware = make_file('fw.bin', stm32_crc.PARALLEL_MIN_SIZE + 1001)
+        app = make_file('app.bin', 20003)
+        image = make_file('image.png', 3001)
+        resource_map = {'friendlyVersion': 'test', 'media': [{'type': 'raw', 'file': 'image.png'}]}
+        resource_map_path = os.path.join(directory, 'map.json')
+        with open(resource_map_path, 'w') as f:
+            json.dump(resource_map, f)
+        builder = pbpack.PbPackBuilder(1, 'test')
+        builder.add_file(image, 'IMAGE')
+        resources = os.path.join(directory, 'app_resources.pbpack')
+        builder.write(resources)
+
+        contents = {}
+        for path in (firmware, app, resources):
+            with open(path, 'rb') as f:
+                contents[os.path.basename(path)] = f.read()
+
+        bundle_path = os.path.join(directory, 'test.pbz')
+        for level in (STORE_LEVEL, 1, MAX_COMPRESS_LEVEL):
+            for store_resources in (False, True):
+                for in_memory in (False, True):
+                    for kind in ('firmware', 'application'):
+                        b = PebbleBundle()
+                        if kind == 'firmware' and in_memory:
+                            b.add_firmware_data('fw.bin', bytearray(contents['fw.bin']), 'normal', 1, 'ev2')
+                        elif kind == 'firmware':
+                            b.add_firmware(firmware, 'normal', 1, 'ev2')
+                        elif in_memory:
+                            b.add_watchapp_data('app.bin', buffer(contents['app.bin']), 1, 1)
+                        else:
+                            b.add_watchapp(app, 1, 1)
+                        if in_memory:
+                            b.add_resources_data('app_resources.pbpack', contents['app_resources.pbpack'],
+                                                 resource_map, 1)
+                        else:
+                            b.add_resources(resources, resource_map_path, 1)
+                        b.write(bundle_path, False, level, store_resources)
+
+                        with zipfile.ZipFile(bundle_path) as z:
+                            assert(z.testzip() is None)
+                            names = [info.filename for info in z.infolist()]
+                            assert(names == [b.bundle_manifest[kind]['name'],
+                                             'app_resources.pbpack', 'manifest.json'])
+                            for info in z.infolist()[:-1]:
+                                assert(z.read(info.filename) == contents[info.filename])
+                                stored = info.compress_type == zipfile.ZIP_STORED
+                                assert(stored == (level == STORE_LEVEL or
+                                                  (store_resources and info.filename == 'app_resources.pbpack')))
+                        assert(verify_bundle(bundle_path) == [])
+    finally:
+        shutil.rmtree(directory)
+
+    print("All tests passed!")
+
+def run_benchmark(args, count):
+    """
+    Build count bundles entirely in memory from the files named in args,
+    read once up front, and report how long it took.
+    """
+    data = read_bundle_files(args)
+
+    total_size = 0
+    start = time.time()
+    for i in xrange(count):
+        b = bundle_from_args(args, data)
+        total_size += len(b.to_bytes(args.compress_level, args.store_resources))
+    elapsed = time.time() - start
+
+    print('built {} bundles ({} bytes) in {:.2f}s: {:.1f}ms each, {:.0f} per minute'.format(
+        count, total_size, elapsed, 1000.0 * elapsed / count, 60 * count / elapsed if elapsed else float('inf')))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a firmware+resources bundle for a Pebble.')
+    add_bundle_arguments(parser)
+    parser.add_argument("-v", "--verbose", help="print additional output", action="store_true")
+    parser.add_argument("-o", "--outfile", help="path to the output file")
+    parser.add_argument("--benchmark", metavar="N", help="build N bundles from the given files in memory, without writing any, and report the time taken", type=int)
+    parser.add_argument("--verify", metavar="BUNDLE", nargs="+", help="check bundles, or directories of them, against their manifests instead of building one, printing a JSON line per bundle")
+    parser.add_argument("--batch", metavar="JOBS", help="build every bundle listed in the JSON or YAML file JOBS, each entry giving this script's flags by name plus an outfile, printing a JSON line per bundle")
+    parser.add_argument("--self-test", help="check that bundles written by this script read back through zipfile, and exit", action="store_true")
+    parser.add_argument("-j", "--jobs", help="number of processes verifying or batch building bundles, one per core by default", type=int)
+    args = parser.parse_args()
+
+    if len(sys.argv) < 2:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.self_test:
+        _self_test()
+        sys.exit(0)
+
+    if args.verify:
+        sys.exit(0 if run_verify(args.verify, args.jobs) else 1)
+
+    if args.batch:
+        sys.exit(0 if run_batch(args.batch, args.jobs) else 1)
+
+    if args.benchmark:
+        run_benchmark(args, args.benchmark)
+        sys.exit(0)
 
-    b.write(args.outfile, args.verbose)
+    b = bundle_from_args(args)
+    b.write(args.outfile, args.verbose, args.compress_level, args.store_resources)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+# PackBits run-length coding for pbpack entries.
+#
+# The stream is a series of control bytes n, each followed by its data:
+#   0..127    copy the next n + 1 bytes
+#   129..255  repeat the next byte 257 - n times
+#   128       no-op
+# Decoding needs no window or tables, only a loop over the control bytes and
+# memcpy/memset, which suits the watch.
+
+import itertools
+
+MAX_RUN = 128
+# Runs shorter than this are cheaper to leave in a literal
+MIN_RUN = 3
+
+# Rough decode cost on the watch's Cortex-M3, for reports: a fixed cost per
+# control byte plus the memcpy/memset of its output
+DECODE_CYCLES_PER_CONTROL = 12
+DECODE_CYCLES_PER_BYTE = 2
+
+def encode(data):
+    out = []
+    literal = []
+
+    def flush_literal():
+        for start in xrange(0, len(literal), MAX_RUN):
+            chunk = literal[start:start + MAX_RUN]
+            out.append(chr(len(chunk) - 1))
+            out.append(''.join(chunk))
+        del literal[:]
+
+    for byte, group in itertools.groupby(data):
+        count = sum(1 for _ in group)
+        while count >= MIN_RUN:
+            run = min(count, MAX_RUN)
+            flush_literal()
+            out.append(chr(257 - run) + byte)
+            count -= run
+        literal.extend(byte * count)
+    flush_literal()
+    return ''.join(out)
+
+def decode(data):
+    out = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+        n = ord(data[pos])
+        pos += 1
+        if n < 128:
+            out.append(data[pos:pos + n + 1])
+            pos += n + 1
+        elif n > 128:
+            out.append(data[pos] * (257 - n))
+            pos += 1
+    return ''.join(out)
+
+def count_controls(data):
+    """The number of control bytes in an encoded stream."""
+    controls = 0
+    pos = 0
+    end = len(data)
+    while pos < end:
+        n = ord(data[pos])
+        controls += 1
+        pos += 1 + (n + 1 if n < 128 else 1 if n > 128 else 0)
+    return controls
+
+def decode_cycles(data, decoded_length):
+    """Estimated cycles for the watch to decode data into decoded_length bytes."""
+    return DECODE_CYCLES_PER_CONTROL * count_controls(data) + DECODE_CYCLES_PER_BYTE * decoded_length
+
+if __name__ == '__main__':
+    import random
+    rand = random.Random(0)
+    for length in range(0, 600):
+        alphabet = [chr(rand.randrange(256)) for i in xrange(rand.randrange(1, 4))]
+        data = ''.join(rand.choice(alphabet) * rand.randrange(1, 300) for i in xrange(length / 20))[:length]
+        assert(decode(encode(data)) == data)
+        noise = ''.join(chr(rand.randrange(256)) for i in xrange(length))
+        assert(decode(encode(noise)) == noise)
+        assert(len(encode(noise)) <= len(noise) + (len(noise) + MAX_RUN - 1) / MAX_RUN)
+    print "All tests passed!"
@@ -0,0 +1,696 @@
+#!/usr/bin/env python
+
+# Assemble a .pbpack in a single pass.
+#
+# A pack is a manifest (number of files, CRC of the data chunk, timestamp and
+# version string), a table with one (id, offset, length, crc) row per file,
+# padded out to MAX_NUM_FILES rows unless the table is sparse, and the data
+# chunk: every file's contents back to back. PbPackBuilder reads each file exactly once, computing its CRC
+# and the running CRC of the data chunk as it goes. Files with identical
+# contents can share a single copy in the data chunk, and files can be stored
+# PackBits-compressed where that makes them smaller.
+#
+# With incremental set, build_pack() keeps an index (PACK.idx) next to the
+# pack of its layout and of the sha1 of each source file it was built from. A
+# rebuild where no entry changed size patches just the entries whose contents
+# changed, their table rows and the manifest in place, instead of writing a
+# new pack.
+#
+# PbPack reads a pack back the way the firmware does, through resource
+# handles, from an mmap of the file.
+
+import argparse
+import collections
+import errno
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+
+import fileutil
+import generate_resource_code
+import packbits
+import stm32_crc
+from pbpack_meta_data import MAX_NUM_FILES, BYTES_PER_TABLE_ENTRY, \
+    TABLE_LAYOUT_FIXED, TABLE_LAYOUT_SPARSE, pack_num_files, unpack_num_files, table_rows
+
+MANIFEST_FORMAT = '<III16s'
+TABLE_ENTRY_FORMAT = '<IIII'
+MANIFEST_SIZE = struct.calcsize(MANIFEST_FORMAT)
+TABLE_LAYOUTS = (TABLE_LAYOUT_FIXED, TABLE_LAYOUT_SPARSE)
+
+# The top byte of a table row's id says how the entry is stored. The length
+# and CRC in the row are those of the stored bytes; a compressed entry starts
+# with the length and CRC of the file before compression.
+COMPRESSION_NONE = 0
+COMPRESSION_PACKBITS = 1
+COMPRESSIONS = (COMPRESSION_NONE, COMPRESSION_PACKBITS)
+ENTRY_FLAGS_SHIFT = 24
+FILE_ID_MASK = (1 << ENTRY_FLAGS_SHIFT) - 1
+COMPRESSED_HEADER_FORMAT = '<II'
+COMPRESSED_HEADER_SIZE = struct.calcsize(COMPRESSED_HEADER_FORMAT)
+
+# Only store a file compressed if that saves at least this fraction of it,
+# otherwise the flash saved isn't worth decompressing it on every load
+COMPRESSION_MIN_SAVING = 0.1
+
+INDEX_VERSION = 2
+
+class PbPackEntry(object):
+    FIELDS = ('file_id', 'def_name', 'path', 'offset', 'length', 'crc', 'sha1',
+              'compression', 'raw_length', 'priority')
+
+    def __init__(self, file_id, def_name, path, offset, length, crc, sha1=None,
+                 compression=COMPRESSION_NONE, raw_length=None, priority=0):
+        self.file_id = file_id
+        self.def_name = def_name
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.crc = crc
+        # Identify the source file the entry was built from, for incremental builds
+        self.sha1 = sha1
+        # length and crc describe the stored bytes, raw_length the file's
+        self.compression = compression
+        self.raw_length = length if raw_length is None else raw_length
+        # Files with a higher priority are placed earlier in the data chunk
+        self.priority = priority
+
+    def table_bits(self):
+        return struct.pack(TABLE_ENTRY_FORMAT, self.file_id | (self.compression << ENTRY_FLAGS_SHIFT),
+                           self.offset, self.length, self.crc)
+
+    def to_json(self):
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+    @classmethod
+    def from_json(cls, obj):
+        return cls(**dict((str(k), v) for k, v in obj.iteritems()))
+
+class PbPackBuilder(object):
+    """
+    Assembles a pack in memory. With dedup set, a file whose contents are
+    already in the pack is not stored again: its table row points at the
+    existing copy instead. layout is one of TABLE_LAYOUTS. With compress
+    set, each file is stored compressed if that makes it smaller.
+
+    Files are placed in the data chunk in order of decreasing priority
+    (and in the order they were added for equal priorities); their ids
+    always follow the order they were added in. With align set, every file
+    starts at a multiple of align bytes from the start of the pack, so a
+    change to one file doesn't move the others to different flash sectors.
+    """
+
+    def __init__(self, timestamp, readable_version, dedup=False, layout=TABLE_LAYOUT_FIXED,
+                 compress=False, align=None):
+        self.timestamp = timestamp
+        self.readable_version = readable_version
+        self.dedup = dedup
+        self.layout = layout
+        self.compress = compress
+        self.align = align
+        self.entries = []
+        # (entry, stored) for every distinct payload, and the entries that
+        # share another entry's payload, as (entry, owner)
+        self.payloads = []
+        self.duplicates = []
+        # (length, crc) -> [(entry, stored)], for dedup
+        self.by_content = {}
+        self.dedup_saved = 0
+
+        # Filled in once the data chunk is laid out
+        self.placed = False
+        self.chunks = []
+        self.data_length = 0
+        self.data_crc = stm32_crc.Crc32Stm()
+        self.padding = 0
+
+    def add_file(self, path, def_name=None, priority=0):
+        if self.placed:
+            raise Exception("Can't add files to a pack that has been laid out")
+        if len(self.entries) >= MAX_NUM_FILES:
+            raise Exception("A pbpack can hold at most {} files".format(MAX_NUM_FILES))
+
+        with open(path, 'rb') as f:
+            content = f.read()
+        stored, compression, crc = stored_form(content, self.compress)
+
+        entry = PbPackEntry(len(self.entries) + 1, def_name, path, None, len(stored), crc,
+                            hashlib.sha1(content).hexdigest(), compression, len(content),
+                            priority)
+        self.entries.append(entry)
+
+        if self.dedup:
+            for owner, other in self.by_content.get((len(stored), crc), ()):
+                if other == stored:
+                    self.duplicates.append((entry, owner))
+                    self.dedup_saved += len(stored)
+                    return entry
+            self.by_content.setdefault((len(stored), crc), []).append((entry, stored))
+        self.payloads.append((entry, stored))
+        return entry
+
+    def _append(self, data):
+        self.chunks.append(data)
+        self.data_length += len(data)
+        self.data_crc.update(data)
+
+    def place(self):
+        """Lay out the data chunk. No files can be added afterwards."""
+        if self.placed:
+            return
+        self.placed = True
+
+        start = data_offset(len(self.entries), self.layout)
+        for entry, stored in sorted(self.payloads, key=lambda p: -p[0].priority):
+            if self.align:
+                padding = -(start + self.data_length) % self.align
+                if padding:
+                    self._append('\0' * padding)
+                    self.padding += padding
+            entry.offset = self.data_length
+            self._append(stored)
+        for entry, owner in self.duplicates:
+            entry.offset = owner.offset
+
+    def manifest_bits(self):
+        self.place()
+        return manifest_bits(len(self.entries), self.data_crc.digest(),
+                             self.timestamp, self.readable_version, self.layout)
+
+    def table_bits(self):
+        self.place()
+        rows = [e.table_bits() for e in self.entries]
+        padding = table_rows(len(self.entries), self.layout) - len(self.entries)
+        rows.append('\0' * (BYTES_PER_TABLE_ENTRY * padding))
+        return ''.join(rows)
+
+    def write(self, pack_path):
+        """
+        Write the pack to pack_path, replacing it atomically. Returns the
+        pack's metadata (see metadata()).
+        """
+        with fileutil.atomic_write(pack_path) as f:
+            f.write(self.manifest_bits())
+            f.write(self.table_bits())
+            f.writelines(self.chunks)
+        return self.metadata()
+
+    def metadata(self):
+        """
+        Everything the resource header needs: the data chunk CRC, timestamp,
+        version and the entries in pack order.
+        """
+        self.place()
+        return {
+            'num_files': len(self.entries),
+            'crc': self.data_crc.digest(),
+            'data_length': self.data_length,
+            'timestamp': self.timestamp,
+            'readable_version': self.readable_version,
+            'entries': self.entries,
+            'dedup': self.dedup,
+            'dedup_saved': self.dedup_saved,
+            'layout': self.layout,
+            'compress': self.compress,
+            'align': self.align,
+            'padding': self.padding,
+            }
+
+def stored_form(content, compress):
+    """
+    Returns (stored, compression, crc): the bytes to store for a file with
+    the given contents, how they are compressed and their CRC. With
+    compress set, the file is compressed if that makes it enough smaller.
+    """
+    crc = stm32_crc.crc32(content)
+    if compress:
+        compressed = (struct.pack(COMPRESSED_HEADER_FORMAT, len(content), crc) +
+                      packbits.encode(content))
+        if len(compressed) <= len(content) * (1 - COMPRESSION_MIN_SAVING):
+            return (compressed, COMPRESSION_PACKBITS, stm32_crc.crc32(compressed))
+    return (content, COMPRESSION_NONE, crc)
+
+def manifest_bits(num_files, crc, timestamp, readable_version, layout=TABLE_LAYOUT_FIXED):
+    return struct.pack(MANIFEST_FORMAT, pack_num_files(num_files, layout), crc,
+                       timestamp, readable_version)
+
+def data_offset(num_files, layout):
+    """Where the data chunk starts in a pack of num_files files."""
+    return MANIFEST_SIZE + table_rows(num_files, layout) * BYTES_PER_TABLE_ENTRY
+
+def index_path(pack_path):
+    return pack_path + '.idx'
+
+def write_index(pack_path, metadata):
+    st = os.stat(pack_path)
+    index = dict(metadata,
+                 version=INDEX_VERSION,
+                 pack_size=st.st_size,
+                 pack_mtime=st.st_mtime,
+                 entries=[e.to_json() for e in metadata['entries']])
+    with fileutil.atomic_write(index_path(pack_path), 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+
+def load_index(pack_path):
+    """
+    Return the metadata recorded for the pack at pack_path, or None if there
+    is no usable index: it's missing, from another version, or the pack has
+    been touched since the index was written.
+    """
+    try:
+        with open(index_path(pack_path)) as f:
+            index = json.load(f)
+        st = os.stat(pack_path)
+    except (IOError, OSError, ValueError):
+        return None
+    if (index.get('version') != INDEX_VERSION or
+            index['pack_size'] != st.st_size or index['pack_mtime'] != st.st_mtime):
+        return None
+    index['entries'] = [PbPackEntry.from_json(e) for e in index['entries']]
+    return index
+
+def patch_pack(pack_path, timestamp, readable_version, resource_pairs, dedup=False,
+               layout=TABLE_LAYOUT_FIXED, compress=False, align=None, priorities=None):
+    """
+    Bring the pack at pack_path up to date with resource_pairs by
+    overwriting only the entries whose files changed. Returns the pack's
+    metadata and the number of patched entries, or (None, 0) if the pack
+    has to be rebuilt because its layout changed.
+    """
+    priorities = priorities or {}
+    metadata = load_index(pack_path)
+    if (metadata is None or metadata.get('dedup', False) != dedup or
+            metadata.get('layout', TABLE_LAYOUT_FIXED) != layout or
+            metadata.get('compress', False) != compress or
+            metadata.get('align') != align or
+            len(metadata['entries']) != len(resource_pairs)):
+        return (None, 0)
+
+    changes = []
+    for entry, (path, def_name) in zip(metadata['entries'], resource_pairs):
+        if entry.path != path or entry.priority != priorities.get(def_name, 0):
+            return (None, 0)
+        entry.def_name = def_name
+        # Every file is read and hashed: an mtime can't be trusted to change
+        # when a file is regenerated within its filesystem's resolution
+        with open(path, 'rb') as f:
+            content = f.read()
+        if len(content) != entry.raw_length:
+            return (None, 0)
+        sha1 = hashlib.sha1(content).hexdigest()
+        if sha1 != entry.sha1:
+            stored, compression, crc = stored_form(content, compress)
+            if len(stored) != entry.length or compression != entry.compression:
+                return (None, 0)
+            entry.sha1 = sha1
+            entry.crc = crc
+            changes.append((entry, stored))
+
+    # A deduplicated copy can't be changed for just one of the entries sharing it
+    shared_offsets = collections.Counter(e.offset for e in metadata['entries'] if e.length)
+    if any(shared_offsets[entry.offset] > 1 for entry, _ in changes):
+        return (None, 0)
+
+    data_start = data_offset(len(metadata['entries']), layout)
+
+    # Nor can a file that now matches another entry be patched in as a
+    # second copy, or the pack would differ from a clean build's
+    if dedup and changes:
+        changed = dict((entry.file_id, stored) for entry, stored in changes)
+        with open(pack_path, 'rb') as f:
+            for entry, stored in changes:
+                for other in metadata['entries']:
+                    if other is entry or (other.length, other.crc) != (entry.length, entry.crc):
+                        continue
+                    if other.file_id in changed:
+                        other_stored = changed[other.file_id]
+                    else:
+                        f.seek(data_start + other.offset)
+                        other_stored = f.read(other.length)
+                    if other_stored == stored:
+                        return (None, 0)
+
+    # If we're interrupted part way through, the next build starts over
+    os.remove(index_path(pack_path))
+
+    crc = metadata['crc']
+    with open(pack_path, 'r+b') as f:
+        for entry, content in changes:
+            f.seek(data_start + entry.offset)
+            old_content = f.read(entry.length)
+            crc = stm32_crc.crc32_patch(crc, metadata['data_length'], entry.offset,
+                                        old_content, content)
+            f.seek(data_start + entry.offset)
+            f.write(content)
+
+            f.seek(MANIFEST_SIZE + (entry.file_id - 1) * BYTES_PER_TABLE_ENTRY)
+            f.write(entry.table_bits())
+
+        f.seek(0)
+        f.write(manifest_bits(len(metadata['entries']), crc, timestamp, readable_version, layout))
+
+    metadata.update(crc=crc, timestamp=timestamp, readable_version=readable_version)
+    return (metadata, len(changes))
+
+def build_pack(pack_path, timestamp, readable_version, resource_pairs, incremental=False,
+               dedup=False, layout=TABLE_LAYOUT_FIXED, compress=False, align=None, priorities=None):
+    """
+    Build a pack from resource_pairs, a list of (path, def_name), and
+    return its metadata. With incremental set, the existing pack is
+    patched in place when possible, and an index is kept next to the pack
+    for the next build to patch it. With dedup set, identical files are
+    stored once, and with compress set, compressed where it helps.
+    priorities maps def_names to their placement priority (see
+    PbPackBuilder).
+    """
+    priorities = priorities or {}
+    metadata = None
+    if incremental:
+        metadata, _ = patch_pack(pack_path, timestamp, readable_version, resource_pairs,
+                                 dedup, layout, compress, align, priorities)
+
+    if metadata is None:
+        builder = PbPackBuilder(timestamp, readable_version, dedup, layout, compress, align)
+        for path, def_name in resource_pairs:
+            builder.add_file(path, def_name, priorities.get(def_name, 0))
+        metadata = builder.write(pack_path)
+
+    if incremental:
+        write_index(pack_path, metadata)
+    else:
+        # An index left by an incremental build no longer describes the pack
+        try:
+            os.remove(index_path(pack_path))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return metadata
+
+class PbPackError(Exception):
+    pass
+
+def _view(buf, offset, length):
+    """A zero-copy slice of buf. Python 2's mmap only supports buffer()."""
+    try:
+        return memoryview(buf)[offset:offset + length]
+    except TypeError:
+        return buffer(buf, offset, length)
+
+class PbPack(object):
+    """
+    Read-only random access to a pack.
+
+    The file is mmapped and the manifest and table rows are only parsed
+    when first needed. Entry contents are returned as zero-copy views of
+    the mmap, so they are only valid until the pack is closed. A pack
+    already in memory can be passed as data, a str or buffer object, in
+    which case path only names it in errors.
+
+    resource_get_handle(), resource_size(), resource_load() and
+    resource_load_byte_range() behave like their namesakes in pebble_os.h,
+    except that they return a view instead of filling in a buffer.
+    Compressed entries are decompressed on load (and are no longer
+    zero-copy); entry_bits() gives the bytes as stored.
+    """
+
+    def __init__(self, path, data=None):
+        self.path = path
+        if data is not None:
+            if len(data) < MANIFEST_SIZE:
+                raise PbPackError("{}: too short to be a pbpack ({} bytes)".format(path, len(data)))
+            self.map = data
+        else:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size < MANIFEST_SIZE:
+                    raise PbPackError("{}: too short to be a pbpack ({} bytes)".format(path, size))
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._manifest = None
+        self._entries = {}
+        # The most recently decompressed entry, for repeated byte range loads
+        self._decoded = (None, None)
+
+    def close(self):
+        if isinstance(self.map, mmap.mmap):
+            self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def manifest(self):
+        """Returns (num_files, crc, timestamp, readable_version, layout)."""
+        if self._manifest is None:
+            num_files, crc, timestamp, readable_version = \
+                struct.unpack_from(MANIFEST_FORMAT, self.map, 0)
+            num_files, layout = unpack_num_files(num_files)
+            if layout not in TABLE_LAYOUTS:
+                raise PbPackError("{}: unknown table layout {}".format(self.path, layout))
+            if num_files > MAX_NUM_FILES:
+                raise PbPackError("{}: manifest claims {} files".format(self.path, num_files))
+            if len(self.map) < data_offset(num_files, layout):
+                raise PbPackError("{}: truncated table".format(self.path))
+            self._manifest = (num_files, crc, timestamp, readable_version.rstrip('\0'), layout)
+        return self._manifest
+
+    @property
+    def num_files(self):
+        return self.manifest()[0]
+
+    @property
+    def crc(self):
+        return self.manifest()[1]
+
+    @property
+    def timestamp(self):
+        return self.manifest()[2]
+
+    @property
+    def readable_version(self):
+        return self.manifest()[3]
+
+    @property
+    def layout(self):
+        return self.manifest()[4]
+
+    @property
+    def data_offset(self):
+        return data_offset(self.num_files, self.layout)
+
+    @property
+    def data_length(self):
+        return len(self.map) - self.data_offset
+
+    def resource_get_handle(self, file_id):
+        """The entry for file_id, or None if the pack has no such file."""
+        if not 1 <= file_id <= self.num_files:
+            return None
+        if file_id not in self._entries:
+            row = MANIFEST_SIZE + (file_id - 1) * BYTES_PER_TABLE_ENTRY
+            table_id, offset, length, crc = struct.unpack_from(TABLE_ENTRY_FORMAT, self.map, row)
+            compression = table_id >> ENTRY_FLAGS_SHIFT
+            if ((table_id & FILE_ID_MASK) != file_id or compression not in COMPRESSIONS or
+                    offset + length > self.data_length or
+                    (compression != COMPRESSION_NONE and length < COMPRESSED_HEADER_SIZE)):
+                raise PbPackError("{}: corrupt table entry for file {}".format(self.path, file_id))
+            raw_length = None
+            if compression != COMPRESSION_NONE:
+                raw_length, _ = struct.unpack_from(COMPRESSED_HEADER_FORMAT, self.map,
+                                                   self.data_offset + offset)
+            self._entries[file_id] = PbPackEntry(file_id, None, None, offset, length, crc,
+                                                 compression=compression, raw_length=raw_length)
+        return self._entries[file_id]
+
+    def entries(self):
+        for file_id in xrange(1, self.num_files + 1):
+            yield self.resource_get_handle(file_id)
+
+    def resource_size(self, handle):
+        return handle.raw_length
+
+    def entry_bits(self, handle):
+        """The entry's bytes as stored in the pack."""
+        return _view(self.map, self.data_offset + handle.offset, handle.length)
+
+    def _decompress(self, handle):
+        if self._decoded[0] is not handle:
+            stored = self.entry_bits(handle)
+            self._decoded = (handle, packbits.decode(stored[COMPRESSED_HEADER_SIZE:]))
+        return self._decoded[1]
+
+    def resource_load(self, handle, max_length=None):
+        if max_length is None:
+            max_length = handle.raw_length
+        return self.resource_load_byte_range(handle, 0, max_length)
+
+    def resource_load_byte_range(self, handle, start_bytes, num_bytes):
+        """Up to num_bytes of the entry starting at start_bytes, clipped to its end."""
+        start_bytes = min(start_bytes, handle.raw_length)
+        num_bytes = min(num_bytes, handle.raw_length - start_bytes)
+        if handle.compression != COMPRESSION_NONE:
+            return _view(self._decompress(handle), start_bytes, num_bytes)
+        return _view(self.map, self.data_offset + handle.offset + start_bytes, num_bytes)
+
+    def data(self):
+        return _view(self.map, self.data_offset, self.data_length)
+
+    def verify_entry(self, handle):
+        if stm32_crc.crc32(self.entry_bits(handle)) != handle.crc:
+            return False
+        if handle.compression != COMPRESSION_NONE:
+            raw_length, raw_crc = struct.unpack_from(COMPRESSED_HEADER_FORMAT, self.entry_bits(handle))
+            content = self.resource_load(handle)
+            return len(content) == raw_length and stm32_crc.crc32(content) == raw_crc
+        return True
+
+    def verify(self):
+        """Check every entry's CRC and the data chunk's. Returns a list of problems."""
+        problems = []
+        for entry in self.entries():
+            if not self.verify_entry(entry):
+                problems.append("file {}: CRC mismatch".format(entry.file_id))
+        if stm32_crc.crc32(self.data()) != self.crc:
+            problems.append("data chunk: CRC mismatch")
+        return problems
+
+def cmd_list(args):
+    with PbPack(args.pack_file) as pack:
+        print "{}: {} files, {} table, version '{}', timestamp {}, crc 0x{:08x}".format(
+            args.pack_file, pack.num_files,
+            'sparse' if pack.layout == TABLE_LAYOUT_SPARSE else 'fixed',
+            pack.readable_version, pack.timestamp, pack.crc)
+        for entry in pack.entries():
+            print "{:4d} offset {:8d} length {:8d} crc 0x{:08x}{}".format(
+                entry.file_id, entry.offset, entry.length, entry.crc,
+                " packbits of {} bytes".format(entry.raw_length) if entry.compression else "")
+
+def cmd_extract(args):
+    with PbPack(args.pack_file) as pack:
+        handle = pack.resource_get_handle(args.file_id)
+        if handle is None:
+            raise PbPackError("{}: no file {}".format(args.pack_file, args.file_id))
+        with open(args.output_file, 'wb') as f:
+            f.write(pack.resource_load(handle))
+
+def cmd_verify(args):
+    with PbPack(args.pack_file) as pack:
+        problems = pack.verify()
+    for problem in problems:
+        print "{}: {}".format(args.pack_file, problem)
+    if problems:
+        sys.exit(1)
+
+def write_compression_report(report_path, pack_path, entries):
+    """
+    Write a table of each entry's raw and stored size and the estimated
+    cycles the watch spends decompressing it. Returns (raw, stored) totals.
+    """
+    lines = ["{:<32} {:>8} {:>8} {:>6} {:>12}".format(
+        "resource", "raw", "stored", "ratio", "decode (cyc)")]
+    total_raw = total_stored = total_cycles = 0
+    with PbPack(pack_path) as pack:
+        for entry in entries:
+            cycles = 0
+            if entry.compression != COMPRESSION_NONE:
+                stored = pack.entry_bits(pack.resource_get_handle(entry.file_id))
+                cycles = packbits.decode_cycles(stored[COMPRESSED_HEADER_SIZE:], entry.raw_length)
+            lines.append("{:<32} {:>8} {:>8} {:>5.0f}% {:>12}".format(
+                entry.def_name or entry.file_id, entry.raw_length, entry.length,
+                100.0 * entry.length / max(entry.raw_length, 1), cycles))
+            total_raw += entry.raw_length
+            total_stored += entry.length
+            total_cycles += cycles
+    lines.append("{:<32} {:>8} {:>8} {:>5.0f}% {:>12}".format(
+        "total", total_raw, total_stored, 100.0 * total_stored / max(total_raw, 1), total_cycles))
+    with open(report_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return (total_raw, total_stored)
+
+def cmd_build(args):
+    if (len(args.resource_pair_list) % 2) != 0:
+        raise Exception("resource_pair_list list must have an even number of entries")
+
+    resource_pairs = zip(args.resource_pair_list[0::2], args.resource_pair_list[1::2])
+    layout = TABLE_LAYOUT_SPARSE if args.sparse_table else TABLE_LAYOUT_FIXED
+    priorities = dict((def_name, int(priority)) for def_name, priority in args.priority or [])
+    metadata = build_pack(args.pack_file, args.timestamp, args.readable_version,
+                          resource_pairs, args.incremental, args.dedup, layout, args.compress,
+                          args.align, priorities)
+
+    if metadata.get('align'):
+        pack_size = data_offset(len(metadata['entries']), layout) + metadata['data_length']
+        print "{}: {} bytes of padding to align files to {} bytes ({:.1%} of the pack)".format(
+            os.path.basename(args.pack_file), metadata['padding'], metadata['align'],
+            float(metadata['padding']) / pack_size)
+
+    if args.compression_report:
+        raw, stored = write_compression_report(args.compression_report, args.pack_file,
+                                               metadata['entries'])
+        compressed = len([e for e in metadata['entries'] if e.compression != COMPRESSION_NONE])
+        print "{}: compressed {} of {} files, {} bytes down to {}, see {}".format(
+            os.path.basename(args.pack_file), compressed, len(metadata['entries']),
+            raw, stored, args.compression_report)
+
+    if metadata.get('dedup_saved'):
+        duplicates = len(metadata['entries']) - len(set((e.offset, e.length) for e in metadata['entries']))
+        print "{}: {} duplicate files stored once, saving {} bytes".format(
+            os.path.basename(args.pack_file), duplicates, metadata['dedup_saved'])
+
+    if args.resource_header:
+        # The CRCs come straight from the pack just built, none are recomputed
+        generate_resource_code.generate_all(
+            metadata, [e.def_name for e in metadata['entries']], args.resource_header,
+            args.version_def_name, args.resource_include,
+            args.font_key_header, args.font_key_table, args.font_key_include,
+            args.font_keys or [], args.version_source)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and inspect pbpack resource packs")
+    subparsers = parser.add_subparsers(help="commands", dest='which')
+
+    build_parser = subparsers.add_parser('build', help="build a pbpack, and optionally its resource id and font key code, in one pass")
+    build_parser.add_argument('pack_file', metavar="PACK_FILE", help="File to write the pack to")
+    build_parser.add_argument('timestamp', metavar="TIMESTAMP", help="timestamp to label this pack with", type=int)
+    build_parser.add_argument('readable_version', metavar="READABLE_VERSION", help="Human readable string to version this pack with")
+    build_parser.add_argument('resource_pair_list', metavar="RESOURCE_PAIR_LIST", help="list of pairs of <filename> <defname>", nargs="*")
+    build_parser.add_argument('--resource-header', metavar="OUTPUT_HEADER", help="Also write the resource id header to this file")
+    build_parser.add_argument('--version-def-name', metavar="VERSION_DEF_NAME", help="Name of the resource version in the header")
+    build_parser.add_argument('--resource-include', metavar="RESOURCE_INCLUDE", help="Include path to insert into the header")
+    build_parser.add_argument('--version-source', metavar="VERSION_SOURCE", help="Define the resource version, which holds the timestamp, in this C file rather than the header")
+    build_parser.add_argument('--font-key-header', metavar="FONT_KEY_HEADER", help="Also write the font key header to this file")
+    build_parser.add_argument('--font-key-table', metavar="FONT_KEY_TABLE", help="Also write the font key table C file to this file")
+    build_parser.add_argument('--font-key-include', metavar="FONT_KEY_INCLUDE", help="Include path of the font key header, for the font key table")
+    build_parser.add_argument('--font-keys', metavar="DEF_NAME", nargs="*", help="defnames of the fonts in the pack")
+    build_parser.add_argument('--incremental', action='store_true', help="Patch the changed entries of an existing pack in place when its layout is unchanged, keeping an index of the pack in PACK_FILE.idx for the next build")
+    build_parser.add_argument('--dedup', action='store_true', help="Store files with identical contents only once")
+    build_parser.add_argument('--sparse-table', action='store_true', help="Only write a table row per file instead of padding the table to {} rows".format(MAX_NUM_FILES))
+    build_parser.add_argument('--compress', action='store_true', help="Store each file PackBits-compressed if that makes it at least {:.0%} smaller".format(COMPRESSION_MIN_SAVING))
+    build_parser.add_argument('--align', metavar="BYTES", type=int, help="Start every file at a multiple of BYTES from the start of the pack, e.g. the flash sector size")
+    build_parser.add_argument('--priority', metavar=("DEF_NAME", "PRIORITY"), nargs=2, action='append', help="Place DEF_NAME before files of a lower priority (0 by default) in the data chunk")
+    build_parser.add_argument('--compression-report', metavar="REPORT_FILE", help="Write each file's raw and stored size and estimated decode cost to this file")
+    build_parser.set_defaults(func=cmd_build)
+
+    list_parser = subparsers.add_parser('list', help="print a pack's manifest and table")
+    list_parser.add_argument('pack_file', metavar="PACK_FILE", help="pack to read")
+    list_parser.set_defaults(func=cmd_list)
+
+    extract_parser = subparsers.add_parser('extract', help="copy one file out of a pack")
+    extract_parser.add_argument('pack_file', metavar="PACK_FILE", help="pack to read")
+    extract_parser.add_argument('file_id', metavar="FILE_ID", help="id of the file to extract, starting at 1", type=int)
+    extract_parser.add_argument('output_file', metavar="OUTPUT_FILE", help="file to write the contents to")
+    extract_parser.set_defaults(func=cmd_extract)
+
+    verify_parser = subparsers.add_parser('verify', help="check the CRCs of every file and of the whole pack")
+    verify_parser.add_argument('pack_file', metavar="PACK_FILE", help="pack to check")
+    verify_parser.set_defaults(func=cmd_verify)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+# Binary deltas between two versions of a pbpack.
+#
+# A delta carries the new pack's manifest and table verbatim, followed by one
+# op per file of the new pack saying where its contents come from:
+#
+#   OP_COPY   an unchanged file of the old pack, by id
+#   OP_PATCH  a file of the old pack of the same length, with the runs of
+#             bytes that differ
+#   OP_DATA   the file's contents, for added files (or when a patch wouldn't
+#             be any smaller)
+#
+# Files of the old pack no op refers to were removed. Unchanged files are
+# found through the CRCs in the two tables, so only files whose CRCs match
+# are compared byte for byte.
+#
+# changed_sectors() compares two packs as the flash sees them instead, one
+# sector at a time, for packs laid out with pbpack.py build --align.
+
+import argparse
+import os
+import shutil
+import struct
+import sys
+import tempfile
+
+import fileutil
+import pbpack
+import stm32_crc
+
+DELTA_MAGIC = 'PBPD'
+DELTA_VERSION = 1
+# magic, version, old pack size, old data chunk CRC, new pack size, table length
+DELTA_HEADER_FORMAT = '<4sIIIII'
+
+OP_COPY = 1
+OP_PATCH = 2
+OP_DATA = 3
+OP_FORMAT = '<BI'
+PATCH_RUN_FORMAT = '<II'
+
+# Modified files are compared in blocks of this many bytes; each run of
+# adjacent differing blocks becomes one run of the patch
+PATCH_BLOCK_SIZE = 32
+
+DEFAULT_SECTOR_SIZE = 4 * 1024
+
+class DeltaError(Exception):
+    pass
+
+def _diff_runs(old, new):
+    """The (offset, length) runs of blocks in which old and new differ."""
+    runs = []
+    for offset in xrange(0, len(new), PATCH_BLOCK_SIZE):
+        if old[offset:offset + PATCH_BLOCK_SIZE] != new[offset:offset + PATCH_BLOCK_SIZE]:
+            length = min(PATCH_BLOCK_SIZE, len(new) - offset)
+            if runs and runs[-1][0] + runs[-1][1] == offset:
+                runs[-1] = (runs[-1][0], runs[-1][1] + length)
+            else:
+                runs.append((offset, length))
+    return runs
+
+def make_delta(old_pack, new_pack):
+    """
+    Compute the delta from old_pack to new_pack, both PbPacks. Returns the
+    delta and a dict counting the files copied, patched, added and removed.
+    """
+    stats = dict(unchanged=0, modified=0, added=0, removed=0)
+
+    old_entries = list(old_pack.entries())
+    old_by_content = {}
+    for entry in old_entries:
+        old_by_content.setdefault((entry.length, entry.crc), entry)
+
+    table = new_pack.map[pbpack.MANIFEST_SIZE:new_pack.data_offset].rstrip('\0')
+    out = [struct.pack(DELTA_HEADER_FORMAT, DELTA_MAGIC, DELTA_VERSION,
+                       len(old_pack.map), old_pack.crc, len(new_pack.map), len(table)),
+           new_pack.map[0:pbpack.MANIFEST_SIZE],
+           table]
+
+    for entry in new_pack.entries():
+        content = new_pack.entry_bits(entry)[:]
+
+        # Prefer the file with the same id, otherwise any file with the same CRC
+        old_entry = old_pack.resource_get_handle(entry.file_id)
+        if old_entry is None or (old_entry.length, old_entry.crc) != (entry.length, entry.crc):
+            old_entry = old_by_content.get((entry.length, entry.crc))
+        if old_entry is not None and old_pack.entry_bits(old_entry)[:] == content:
+            out.append(struct.pack(OP_FORMAT, OP_COPY, old_entry.file_id))
+            stats['unchanged'] += 1
+            continue
+
+        old_entry = old_pack.resource_get_handle(entry.file_id)
+        if old_entry is not None and old_entry.length == entry.length:
+            stats['modified'] += 1
+            runs = _diff_runs(old_pack.entry_bits(old_entry)[:], content)
+            patch_size = struct.calcsize(PATCH_RUN_FORMAT) * (len(runs) + 1) + sum(r[1] for r in runs)
+            if patch_size < entry.length:
+                out.append(struct.pack(OP_FORMAT, OP_PATCH, old_entry.file_id))
+                out.append(struct.pack(PATCH_RUN_FORMAT, len(runs), 0))
+                for offset, length in runs:
+                    out.append(struct.pack(PATCH_RUN_FORMAT, offset, length))
+                    out.append(content[offset:offset + length])
+                continue
+        elif old_entry is not None:
+            stats['modified'] += 1
+        else:
+            stats['added'] += 1
+
+        out.append(struct.pack(OP_FORMAT, OP_DATA, len(content)))
+        out.append(content)
+
+    stats['removed'] = len([e for e in old_entries
+                            if new_pack.resource_get_handle(e.file_id) is None])
+    return ''.join(out), stats
+
+def apply_delta(old_pack, delta):
+    """Rebuild the new pack from old_pack, a PbPack, and a delta. Returns the pack."""
+    header_size = struct.calcsize(DELTA_HEADER_FORMAT)
+    magic, version, old_size, old_crc, new_size, table_length = \
+        struct.unpack_from(DELTA_HEADER_FORMAT, delta, 0)
+    if magic != DELTA_MAGIC or version != DELTA_VERSION:
+        raise DeltaError("not a version {} pbpack delta".format(DELTA_VERSION))
+    if len(old_pack.map) != old_size or old_pack.crc != old_crc:
+        raise DeltaError("delta does not apply to {}".format(old_pack.path))
+
+    pos = header_size
+    out = bytearray(new_size)
+    out[0:pbpack.MANIFEST_SIZE + table_length] = delta[pos:pos + pbpack.MANIFEST_SIZE + table_length]
+    pos += pbpack.MANIFEST_SIZE + table_length
+
+    op_size = struct.calcsize(OP_FORMAT)
+    run_size = struct.calcsize(PATCH_RUN_FORMAT)
+
+    # The new pack's table says where each file goes; the ops what goes there
+    num_files, layout = pbpack.unpack_num_files(struct.unpack_from(pbpack.MANIFEST_FORMAT, out, 0)[0])
+    data_offset = pbpack.data_offset(num_files, layout)
+    for i in xrange(num_files):
+        file_id, offset, length, crc = struct.unpack_from(
+            pbpack.TABLE_ENTRY_FORMAT, out, pbpack.MANIFEST_SIZE + i * pbpack.BYTES_PER_TABLE_ENTRY)
+        start = data_offset + offset
+
+        op, arg = struct.unpack_from(OP_FORMAT, delta, pos)
+        pos += op_size
+        if op == OP_DATA:
+            if arg != length:
+                raise DeltaError("file {} has the wrong length in the delta".format(file_id))
+            out[start:start + arg] = delta[pos:pos + arg]
+            pos += arg
+        elif op in (OP_COPY, OP_PATCH):
+            old_entry = old_pack.resource_get_handle(arg)
+            if old_entry is None:
+                raise DeltaError("delta refers to missing file {}".format(arg))
+            if old_entry.length != length:
+                raise DeltaError("file {} has the wrong length in the delta".format(file_id))
+            out[start:start + old_entry.length] = old_pack.entry_bits(old_entry)[:]
+            if op == OP_PATCH:
+                num_runs, _ = struct.unpack_from(PATCH_RUN_FORMAT, delta, pos)
+                pos += run_size
+                for _ in xrange(num_runs):
+                    run_offset, run_length = struct.unpack_from(PATCH_RUN_FORMAT, delta, pos)
+                    pos += run_size
+                    out[start + run_offset:start + run_offset + run_length] = delta[pos:pos + run_length]
+                    pos += run_length
+        else:
+            raise DeltaError("unknown op {} in delta".format(op))
+
+    if pos != len(delta):
+        raise DeltaError("trailing data in delta")
+    result = str(out)
+    expected_crc = struct.unpack_from(pbpack.MANIFEST_FORMAT, result, 0)[1]
+    if stm32_crc.crc32(buffer(result, data_offset)) != expected_crc:
+        raise DeltaError("CRC mismatch in the rebuilt pack")
+    return result
+
+def changed_sectors(old, new, sector_size=DEFAULT_SECTOR_SIZE):
+    """
+    The indices of the sector_size byte sectors that differ between the
+    packs old and new (as strings), including any the new pack adds.
+    """
+    sectors = (len(new) + sector_size - 1) / sector_size
+    return [i for i in xrange(sectors)
+            if old[i * sector_size:(i + 1) * sector_size] != new[i * sector_size:(i + 1) * sector_size]]
+
+def cmd_diff(args):
+    with pbpack.PbPack(args.old_pack) as old_pack:
+        with pbpack.PbPack(args.new_pack) as new_pack:
+            delta, stats = make_delta(old_pack, new_pack)
+            new_size = len(new_pack.map)
+    with fileutil.atomic_write(args.delta_file) as f:
+        f.write(delta)
+    print "{unchanged} unchanged, {modified} modified, {added} added, {removed} removed".format(**stats)
+    print "delta is {} bytes, new pack {} bytes".format(len(delta), new_size)
+
+def cmd_apply(args):
+    with open(args.delta_file, 'rb') as f:
+        delta = f.read()
+    with pbpack.PbPack(args.old_pack) as old_pack:
+        result = apply_delta(old_pack, delta)
+    with fileutil.atomic_write(args.output_pack) as f:
+        f.write(result)
+
+def cmd_check(args):
+    """Round trip: diff the packs, apply the delta and compare with the new pack."""
+    with pbpack.PbPack(args.old_pack) as old_pack:
+        with pbpack.PbPack(args.new_pack) as new_pack:
+            delta, stats = make_delta(old_pack, new_pack)
+            new = new_pack.map[:]
+        result = apply_delta(old_pack, delta)
+    if result != new:
+        raise DeltaError("apply(old, delta) differs from the new pack")
+    print "ok: delta is {} bytes, new pack {} bytes".format(len(delta), len(new))
+
+def cmd_sectors(args):
+    with open(args.old_pack, 'rb') as f:
+        old = f.read()
+    with open(args.new_pack, 'rb') as f:
+        new = f.read()
+    changed = changed_sectors(old, new, args.sector_size)
+    sectors = (len(new) + args.sector_size - 1) / args.sector_size
+    print "{} of {} {}-byte sectors changed: {}".format(
+        len(changed), sectors, args.sector_size, ' '.join(str(i) for i in changed))
+
+def main():
+    parser = argparse.ArgumentParser(description="Make and apply deltas between pbpacks")
+    subparsers = parser.add_subparsers(help="commands", dest='which')
+
+    diff_parser = subparsers.add_parser('diff', help="make a delta from OLD_PACK to NEW_PACK")
+    diff_parser.add_argument('old_pack', metavar="OLD_PACK", help="pack the delta applies to")
+    diff_parser.add_argument('new_pack', metavar="NEW_PACK", help="pack the delta produces")
+    diff_parser.add_argument('delta_file', metavar="DELTA_FILE", help="file to write the delta to")
+    diff_parser.set_defaults(func=cmd_diff)
+
+    apply_parser = subparsers.add_parser('apply', help="apply a delta to OLD_PACK")
+    apply_parser.add_argument('old_pack', metavar="OLD_PACK", help="pack to apply the delta to")
+    apply_parser.add_argument('delta_file', metavar="DELTA_FILE", help="the delta")
+    apply_parser.add_argument('output_pack', metavar="OUTPUT_PACK", help="file to write the new pack to")
+    apply_parser.set_defaults(func=cmd_apply)
+
+    check_parser = subparsers.add_parser('check', help="check that a delta from OLD_PACK to NEW_PACK round trips")
+    check_parser.add_argument('old_pack', metavar="OLD_PACK", help="old pack")
+    check_parser.add_argument('new_pack', metavar="NEW_PACK", help="new pack")
+    check_parser.set_defaults(func=cmd_check)
+
+    sectors_parser = subparsers.add_parser('sectors', help="list the flash sectors that differ between OLD_PACK and NEW_PACK")
+    sectors_parser.add_argument('old_pack', metavar="OLD_PACK", help="old pack")
+    sectors_parser.add_argument('new_pack', metavar="NEW_PACK", help="new pack")
+    sectors_parser.add_argument('--sector-size', type=int, default=DEFAULT_SECTOR_SIZE, help="flash sector size in bytes")
+    sectors_parser.set_defaults(func=cmd_sectors)
+
+    args = parser.parse_args()
+    args.func(args)
+
+def _self_test():
+    import random
+    rand = random.Random(0)
+
+    def noise(length):
+        return ''.join(chr(rand.randrange(256)) for i in xrange(length))
+
+    def runs(length):
+        return ''.join(chr(rand.randrange(4)) * rand.randrange(1, 40) for i in xrange(length))[:length]
+
+    def tweak(data, *offsets):
+        data = bytearray(data)
+        for offset in offsets:
+            data[offset] ^= 0xff
+        return str(data)
+
+    a, b, c, d = noise(1000), noise(2000), runs(3000), noise(500)
+    base = [a, b, c, d]
+    versions = [
+        ('unchanged', base, dict(unchanged=4)),
+        ('patched', [tweak(a, 10, 700), b, c, d], dict(unchanged=3, modified=1)),
+        ('resized', [a, b + noise(100), c, d[:300]], dict(unchanged=2, modified=2)),
+        ('added', base + [noise(800)], dict(unchanged=4, added=1)),
+        ('removed', [a, b, c], dict(unchanged=3, removed=1)),
+        ('duplicated', [a, b, c, d, a, c], dict(unchanged=6, added=0)),
+        ('reordered', [d, c, b, a], dict(unchanged=4)),
+        ]
+    configs = [
+        dict(),
+        dict(dedup=True),
+        dict(layout=pbpack.TABLE_LAYOUT_SPARSE),
+        dict(align=512),
+        dict(compress=True),
+        dict(dedup=True, layout=pbpack.TABLE_LAYOUT_SPARSE, compress=True, align=256),
+        ]
+
+    directory = tempfile.mkdtemp()
+    try:
+        def build(name, timestamp, contents, config):
+            builder = pbpack.PbPackBuilder(timestamp, 'v{}'.format(timestamp), **config)
+            for i, content in enumerate(contents):
+                path = os.path.join(directory, '{}.{}'.format(name, i))
+                with open(path, 'wb') as f:
+                    f.write(content)
+                builder.add_file(path)
+            path = os.path.join(directory, name + '.pbpack')
+            builder.write(path)
+            return path
+
+        for config in configs:
+            old_path = build('old', 1, base, config)
+            for name, contents, expected_stats in versions:
+                new_path = build(name, 2, contents, config)
+                with pbpack.PbPack(old_path) as old_pack:
+                    with pbpack.PbPack(new_path) as new_pack:
+                        delta, stats = make_delta(old_pack, new_pack)
+                        new = new_pack.map[:]
+                    assert(apply_delta(old_pack, delta) == new)
+                # Compression and alignment don't change which files are reused
+                for key, count in expected_stats.iteritems():
+                    assert(stats[key] == count)
+                if name == 'unchanged':
+                    assert(len(delta) < len(new) / 10)
+                if name == 'patched':
+                    # Sent as a patch, not the whole file
+                    assert(len(delta) < len(a))
+
+        # A delta only applies to the pack it was made from
+        other_path = build('other', 3, [b, a], dict())
+        with pbpack.PbPack(other_path) as other_pack:
+            with pbpack.PbPack(os.path.join(directory, 'patched.pbpack')) as new_pack:
+                with pbpack.PbPack(os.path.join(directory, 'old.pbpack')) as old_pack:
+                    delta, _ = make_delta(old_pack, new_pack)
+            try:
+                apply_delta(other_pack, delta)
+                assert(False)
+            except DeltaError:
+                pass
+    finally:
+        shutil.rmtree(directory)
+
+    print "All tests passed!"
+
+if __name__ == "__main__":
+    # With no command, test the module
+    if len(sys.argv) < 2:
+        _self_test()
+    else:
+        main()
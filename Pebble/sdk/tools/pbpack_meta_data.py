@@ -9,11 +9,33 @@ import stm32_crc
 MAX_NUM_FILES = 256
 BYTES_PER_TABLE_ENTRY = 16
 
+# The top byte of the manifest's file count says how the table is laid out:
+# fixed tables are always padded to MAX_NUM_FILES rows, sparse tables only
+# have a row per file.
+TABLE_LAYOUT_FIXED = 0
+TABLE_LAYOUT_SPARSE = 1
+TABLE_LAYOUT_SHIFT = 24
+NUM_FILES_MASK = (1 << TABLE_LAYOUT_SHIFT) - 1
+
+def pack_num_files(num_files, layout):
+    return num_files | (layout << TABLE_LAYOUT_SHIFT)
+
+def unpack_num_files(value):
+    """Split the manifest's file count into (num_files, layout)."""
+    return (value & NUM_FILES_MASK, value >> TABLE_LAYOUT_SHIFT)
+
+def table_rows(num_files, layout):
+    return num_files if layout == TABLE_LAYOUT_SPARSE else MAX_NUM_FILES
+
+def table_layout(args):
+    return TABLE_LAYOUT_SPARSE if args.sparse else TABLE_LAYOUT_FIXED
+
 def cmd_manifest(args):
     with open(args.manifest_file, 'wb') as manifest_file:
         with open(args.data_chunk_file, 'rb') as data_file:
             crc = stm32_crc.crc32(data_file.read())
-            manifest_file.write(struct.pack('<III16s', int(args.num_files), crc, int(args.timestamp), args.readable_version))
+            num_files = pack_num_files(int(args.num_files), table_layout(args))
+            manifest_file.write(struct.pack('<III16s', num_files, crc, int(args.timestamp), args.readable_version))
 
 def cmd_table(args):
     with open(args.table_file, 'wb') as table_file:
@@ -30,7 +52,7 @@ def cmd_table(args):
                 next_free_byte += length
 
         # pad the rest of the file
-        for i in range(len(args.pack_file_list), MAX_NUM_FILES):
+        for i in range(len(args.pack_file_list), table_rows(len(args.pack_file_list), table_layout(args))):
             table_file.write(struct.pack('<IIII', 0, 0, 0, 0))
 
 def main():
@@ -44,11 +66,13 @@ def main():
     manifest_parser.add_argument('timestamp', metavar="TIMESTAMP", help="timestamp to label this pack with", type=int)
     manifest_parser.add_argument('readable_version', metavar="READABLE_VERSION", help="Human readable string to version this file wth")
     manifest_parser.add_argument('data_chunk_file', metavar="DATA_CHUNK_FILE", help="The data file to CRC for this pack")
+    manifest_parser.add_argument('--sparse', action='store_true', help="Mark the pack's table as sparse")
     manifest_parser.set_defaults(func=cmd_manifest)
     
     table_parser = subparsers.add_parser('table', help="make the metadata table")
     table_parser.add_argument('table_file', metavar='TABLE_FILE', help="file to write the table chunk to")
     table_parser.add_argument('pack_file_list', metavar='PACK_FILE_LIST', nargs="*", help="a list of <pack_file_path>s")
+    table_parser.add_argument('--sparse', action='store_true', help="Only write a row per file instead of padding the table to {} rows".format(MAX_NUM_FILES))
     table_parser.set_defaults(func=cmd_table)
 
     args = parser.parse_args()
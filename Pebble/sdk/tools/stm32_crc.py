@@ -1,36 +1,322 @@
 import array
+import collections
+import multiprocessing
+import os
 import sys
 
 CRC_POLY = 0x04C11DB7
 
-def process_word(data, crc=0xffffffff):
-    if (len(data) < 4):
-        d_array = array.array('B', data)
-        for x in range(0, 4 - len(data)):
-            d_array.insert(0,0)
-        d_array.reverse()
-        data = d_array.tostring()
-
-    d = array.array('I', data)[0]
-    crc = crc ^ d
+# Buffers smaller than this are not worth the cost of starting a process pool
+PARALLEL_MIN_SIZE = 512 * 1024
+READ_CHUNK_SIZE = 64 * 1024
 
+def _shift_word(crc):
+    """Run the bitwise CRC register forward by 32 bits with no new input."""
     for i in xrange(0, 32):
         if (crc & 0x80000000) != 0:
             crc = (crc << 1) ^ CRC_POLY
         else:
             crc = (crc << 1)
+    return crc & 0xffffffff
+
+# Slicing-by-4 tables: _TABLES[n][b] is the CRC register after shifting the
+# byte b, placed at bit offset 8 * n, through a full 32-bit word.
+_TABLES = [array.array('I', [_shift_word(b << (8 * n)) for b in xrange(256)]) for n in xrange(4)]
+
+def _pad_partial_word(data):
+    """
+    Turn a trailing partial word into the value process_word() CRCs for it:
+    the bytes are left-padded with zeros and then reversed.
+    """
+    d_array = array.array('B', data)
+    for x in range(0, 4 - len(data)):
+        d_array.insert(0,0)
+    d_array.reverse()
+    return array.array('I', d_array.tostring())[0]
+
+def _process_words(words, crc):
+    t0, t1, t2, t3 = _TABLES
+    for d in words:
+        crc ^= d
+        crc = t3[crc >> 24] ^ t2[(crc >> 16) & 0xff] ^ t1[(crc >> 8) & 0xff] ^ t0[crc & 0xff]
+    return crc
+
+class Crc32Stm(object):
+    """
+    Incremental, table-driven STM32 CRC.
+
+    Data can be fed in pieces of any size through update(); digest() returns the
+    same value process_buffer() would for the concatenation of everything fed so
+    far, including the padding of a trailing partial word.
+    """
+
+    def __init__(self, data=None, crc=0xffffffff):
+        self.crc = crc
+        self.pending = ''
+        if data:
+            self.update(data)
+
+    def update(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif not isinstance(data, str):
+            data = str(data)
+        if self.pending:
+            data = self.pending + data
+        whole = len(data) & ~3
+        if whole:
+            self.crc = _process_words(array.array('I', data[:whole]), self.crc)
+        self.pending = data[whole:]
+        return self
+
+    def digest(self):
+        if not self.pending:
+            return self.crc
+        return _process_words((_pad_partial_word(self.pending),), self.crc)
+
+    def copy(self):
+        other = Crc32Stm(crc=self.crc)
+        other.pending = self.pending
+        return other
 
-    result = crc & 0xffffffff
+def _gf2_matrix_times(mat, vec):
+    result = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            result ^= mat[i]
+        vec >>= 1
+        i += 1
     return result
 
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[i]) for i in xrange(32)]
+
+# _SHIFT_OPERATORS[n] is the GF(2) matrix (as a list of 32 columns) that
+# advances the CRC register over 2 ** n words of zeros.
+_SHIFT_OPERATORS = [[_shift_word(1 << i) for i in xrange(32)]]
+
+def crc32_shift(crc, word_count):
+    """Return the CRC register after feeding it word_count zero words."""
+    n = 0
+    while word_count:
+        if n == len(_SHIFT_OPERATORS):
+            _SHIFT_OPERATORS.append(_gf2_matrix_square(_SHIFT_OPERATORS[-1]))
+        if word_count & 1:
+            crc = _gf2_matrix_times(_SHIFT_OPERATORS[n], crc)
+        word_count >>= 1
+        n += 1
+    return crc
+
+def crc32_combine(crc1, crc2, len2):
+    """
+    Combine the CRC of two consecutive pieces of a buffer.
+
+    crc1 is the CRC of the first piece, which must be a whole number of words
+    long. crc2 is the CRC of the second piece, len2 bytes long, computed with
+    an initial value of 0. The result is the CRC of the concatenation.
+    """
+    return crc32_shift(crc1, (len2 + 3) / 4) ^ crc2
+
+def crc32_patch(crc, total_length, offset, old, new):
+    """
+    Return the CRC of a total_length byte buffer, whose CRC was crc, after the
+    bytes old at offset have been overwritten with new (of the same length).
+    Only the overwritten bytes need to be read.
+    """
+    if len(old) != len(new):
+        raise ValueError("old and new must be the same length")
+    if not new:
+        return crc
+
+    # The CRC is linear in its input, so XORing the buffer with a delta that
+    # is zero outside the patched words changes the CRC by the delta's CRC
+    # (with an initial value of 0), shifted past the words that follow it.
+    # With an initial value of 0 the delta's CRC is in turn the XOR of the
+    # CRCs of the old and new words.
+    start = offset & ~3
+    end = min((offset + len(new) + 3) & ~3, total_length)
+    before = '\0' * (offset - start)
+    after = '\0' * (end - offset - len(new))
+    delta_crc = (Crc32Stm(before + old + after, 0).digest() ^
+                 Crc32Stm(before + new + after, 0).digest())
+
+    trailing_words = (total_length + 3) / 4 - (end + 3) / 4
+    return crc ^ crc32_shift(delta_crc, trailing_words)
+
+def _crc_chunk(job):
+    path, data, offset, length, init = job
+    crc = Crc32Stm(crc=init)
+    if path is not None:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while length > 0:
+                data = f.read(min(length, READ_CHUNK_SIZE))
+                if not data:
+                    break
+                crc.update(data)
+                length -= len(data)
+    else:
+        crc.update(data)
+    return crc.digest()
+
+def _crc_jobs_parallel(jobs, workers):
+    """CRC the chunks jobs describe in a pool of workers and combine the results."""
+    pool = multiprocessing.Pool(workers)
+    try:
+        crcs = pool.map(_crc_chunk, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    crc = crcs[0]
+    for job, chunk_crc in zip(jobs[1:], crcs[1:]):
+        crc = crc32_combine(crc, chunk_crc, job[3])
+    return crc
+
+def _parallel_chunk_size(length, workers):
+    """A word-aligned chunk size splitting length bytes between workers."""
+    return ((length + workers - 1) / workers + 3) & ~3
+
+def crc32_parallel(buf, workers=None):
+    """
+    CRC a buffer by splitting it into word-aligned chunks, CRCing them in a
+    process pool and combining the results.
+
+    buf is a str, bytearray, buffer or memoryview. The result is identical to
+    crc32().
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    length = len(buf)
+
+    def chunk(offset, size):
+        if isinstance(buf, memoryview):
+            return buf[offset:offset + size].tobytes()
+        return buffer(buf, offset, size)[:]
+
+    if workers <= 1 or length < PARALLEL_MIN_SIZE:
+        return _crc_chunk((None, chunk(0, length), 0, length, 0xffffffff))
+
+    chunk_size = _parallel_chunk_size(length, workers)
+    jobs = []
+    for offset in xrange(0, length, chunk_size):
+        size = min(chunk_size, length - offset)
+        init = 0xffffffff if offset == 0 else 0
+        jobs.append((None, chunk(offset, size), 0, size, init))
+    return _crc_jobs_parallel(jobs, workers)
+
+def crc32_parallel_file(path, workers=None):
+    """
+    CRC the file at path like crc32_parallel(), each worker reading its own
+    chunk of the file.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    length = os.path.getsize(path)
+
+    if workers <= 1 or length < PARALLEL_MIN_SIZE:
+        return _crc_chunk((path, None, 0, length, 0xffffffff))
+
+    chunk_size = _parallel_chunk_size(length, workers)
+    jobs = []
+    for offset in xrange(0, length, chunk_size):
+        size = min(chunk_size, length - offset)
+        init = 0xffffffff if offset == 0 else 0
+        jobs.append((path, None, offset, size, init))
+    return _crc_jobs_parallel(jobs, workers)
+
+class ParallelCrc32Stm(object):
+    """
+    Incremental STM32 CRC, like Crc32Stm, that CRCs the data fed to update()
+    in a process pool, chunk_size bytes per job, and combines the results in
+    order. At most two jobs per worker are in flight at a time, so however
+    much data is fed the memory held stays bounded. Call close() when done
+    with it, digest() closes it too.
+    """
+
+    def __init__(self, workers=None, chunk_size=PARALLEL_MIN_SIZE):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.chunk_size = chunk_size & ~3
+        self.max_in_flight = 2 * workers
+        self.pool = multiprocessing.Pool(workers)
+        self.in_flight = collections.deque()
+        self.pending = []
+        self.pending_length = 0
+        self.crc = None
+
+    def _submit(self, data):
+        init = 0xffffffff if self.crc is None and not self.in_flight else 0
+        self.in_flight.append((self.pool.apply_async(_crc_chunk, ((None, data, 0, len(data), init),)),
+                               len(data)))
+        while len(self.in_flight) > self.max_in_flight:
+            self._collect()
+
+    def _collect(self):
+        result, length = self.in_flight.popleft()
+        chunk_crc = result.get()
+        self.crc = chunk_crc if self.crc is None else crc32_combine(self.crc, chunk_crc, length)
+
+    def update(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif not isinstance(data, str):
+            data = str(data)
+        self.pending.append(data)
+        self.pending_length += len(data)
+        if self.pending_length >= self.chunk_size:
+            data = ''.join(self.pending)
+            whole = len(data) - len(data) % self.chunk_size
+            for offset in xrange(0, whole, self.chunk_size):
+                self._submit(data[offset:offset + self.chunk_size])
+            self.pending = [data[whole:]]
+            self.pending_length = len(data) - whole
+        return self
+
+    def digest(self):
+        if self.pending_length or (self.crc is None and not self.in_flight):
+            self._submit(''.join(self.pending))
+            self.pending = []
+            self.pending_length = 0
+        while self.in_flight:
+            self._collect()
+        self.close()
+        return self.crc
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def process_word(data, crc=0xffffffff):
+    if (len(data) < 4):
+        d = _pad_partial_word(data)
+    else:
+        d = array.array('I', data)[0]
+    return _process_words((d,), crc)
+
 def process_buffer(buf, c = 0xffffffff):
+    return Crc32Stm(buf, c).digest()
+
+def process_word_bitwise(data, crc=0xffffffff):
+    """Reference bit-by-bit implementation of process_word()."""
+    if (len(data) < 4):
+        d = _pad_partial_word(data)
+    else:
+        d = array.array('I', data)[0]
+    return _shift_word(crc ^ d)
+
+def process_buffer_bitwise(buf, c = 0xffffffff):
+    """Reference bit-by-bit implementation of process_buffer()."""
     word_count = len(buf) / 4
     if (len(buf) % 4 != 0):
         word_count += 1
 
     crc = c
     for i in xrange(0, word_count):
-        crc = process_word(buf[i * 4 : (i + 1) * 4], crc)
+        crc = process_word_bitwise(buf[i * 4 : (i + 1) * 4], crc)
     return crc
 
 def crc32(data):
@@ -42,9 +328,47 @@ if __name__ == '__main__':
     assert(0x519b130 == process_buffer("\xfe\xff\xfe\xff"))
     assert(0x495e02ca == process_buffer("\xfe\xff\xfe\xff\x88"))
 
+    import random
+    rand = random.Random(0)
+    for length in range(0, 67):
+        buf = ''.join(chr(rand.randrange(256)) for i in xrange(length))
+        expected = process_buffer_bitwise(buf)
+        assert(expected == process_buffer(buf))
+        for split in range(0, length + 1):
+            assert(expected == Crc32Stm(buf[:split]).update(buf[split:]).digest())
+            if split % 4 == 0:
+                tail = Crc32Stm(buf[split:], 0).digest()
+                assert(expected == crc32_combine(Crc32Stm(buf[:split]).digest(), tail, length - split))
+        for offset in range(0, length):
+            for size in range(0, min(length - offset, 9) + 1):
+                patch = ''.join(chr(rand.randrange(256)) for i in xrange(size))
+                patched = buf[:offset] + patch + buf[offset + size:]
+                assert(process_buffer(patched) ==
+                       crc32_patch(expected, length, offset, buf[offset:offset + size], patch))
+
+    for length in (0, 3, 100, 4096, 10007):
+        buf = ''.join(chr(rand.randrange(256)) for i in xrange(length))
+        crc = ParallelCrc32Stm(workers=2, chunk_size=1024)
+        for offset in xrange(0, length, 333):
+            crc.update(buf[offset:offset + 333])
+        assert(crc.digest() == process_buffer(buf))
+
+    import tempfile
+    for length in (1000, PARALLEL_MIN_SIZE + 1, PARALLEL_MIN_SIZE + 4097):
+        buf = ''.join(chr(rand.randrange(256)) for i in xrange(length))
+        expected = process_buffer(buf)
+        for data in (buf, bytearray(buf), buffer(buf), memoryview(buf)):
+            assert(crc32_parallel(data, workers=3) == expected)
+        assert(crc32_parallel(buf, workers=1) == expected)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(buf)
+            f.flush()
+            assert(crc32_parallel_file(f.name, workers=3) == expected)
+            assert(crc32_parallel_file(f.name, workers=1) == expected)
+
     print "All tests passed!"
-    
+
     if len(sys.argv) >= 2:
-        b = open(sys.argv[1]).read()
+        b = open(sys.argv[1], 'rb').read()
         crc = crc32(b)
-        print "%u or 0x%x" % (crc, crc)
\ No newline at end of file
+        print "%u or 0x%x" % (crc, crc)
@@ -1,9 +1,30 @@
 import json
 import os, sys
+import pipes
 import time
 import re
 import waflib
 
+import resource_cache
+
+def report_glyph_cache_stats(stats_path):
+    """Sum up the hit/miss lines each fontgen run appended to stats_path."""
+    if not os.path.exists(stats_path):
+        return
+    hits = misses = 0
+    with open(stats_path) as stats_file:
+        for line in stats_file:
+            fields = line.split()
+            if len(fields) == 2:
+                hits += int(fields[0])
+                misses += int(fields[1])
+    os.remove(stats_path)
+
+    lookups = hits + misses
+    if lookups:
+        waflib.Logs.info("Glyph cache: {} hits, {} misses ({:.0f}% hit rate)".format(
+            hits, misses, 100.0 * hits / lookups))
+
 def gen_resource_deps(bld,
                       map_node,
                       pack_node,
@@ -12,29 +33,100 @@ def gen_resource_deps(bld,
                       font_key_header_node=None,
                       font_key_table_node=None,
                       font_key_include_path=None,
-                      timestamp=None):
+                      timestamp=None,
+                      glyph_cache=None,
+                      sparse_table=False,
+                      compress=False,
+                      align=None,
+                      dedup=False,
+                      version_source_node=None,
+                      resource_cache_dir=None,
+                      resource_cache_size=None):
     """
     Creates tasks to generate the resources described in the map file,
     Assumes that the map file is in the resource src directory
+
+    If glyph_cache is the path of a directory, fonts are rendered through a
+    glyph cache kept there and its hit rate is reported at the end of the build.
+
+    If sparse_table is set, the pack's table only has a row per resource
+    instead of being padded to 256 rows.
+
+    If compress is set, resources are stored compressed where that makes
+    them smaller, and a report of the savings is written next to the pack.
+
+    If dedup is set, resources with identical contents share one copy in
+    the pack.
+
+    If align is set, every resource starts on a multiple of align bytes in
+    the pack. Resources with a higher "packPriority" in the map (0 by
+    default) are placed first, so large resources that rarely change can
+    be kept ahead of those that often do.
+
+    If version_source_node is given, the resource version, which holds the
+    timestamp, is defined in that C file instead of the id header. Generated
+    files are only rewritten when their contents change, so with it a
+    rebuild with unchanged resources leaves the header, and everything
+    including it, alone.
+    If resource_cache_dir is the path of a directory, generated images and
+    fonts are kept in a cache there, shared between builds and projects,
+    and taken from it rather than regenerated when their inputs, arguments
+    and generator are unchanged. resource_cache_size bounds the cache's
+    disk usage in megabytes, 256 by default.
     """
 
     res_src_node = map_node.parent
-    bitmap_script = bld.path.parent.find_node('tools/bitmapgen.py')
-    font_script = bld.path.parent.find_node('tools/font/fontgen.py')
+    tools_node = bld.path.parent.find_node('tools')
+    bitmap_script = tools_node.find_node('bitmapgen.py')
+    font_script = tools_node.find_node('font/fontgen.py')
+
+    # Each generator script and the modules it imports, which its outputs
+    # depend on as much as on the script
+    bitmap_tools = [bitmap_script] + [tools_node.find_node(m) for m in
+                                      ('bitpack.py', 'fileutil.py')]
+    font_tools = [font_script] + [tools_node.find_node(m) for m in
+                                  ('bitpack.py', 'fileutil.py', 'font/glyph_cache.py',
+                                   'cache_dir.py')]
+
+    cache = None
+    if resource_cache_dir:
+        max_bytes = resource_cache_size * 1024 * 1024 if resource_cache_size else None
+        cache = resource_cache.get_cache(bld, resource_cache_dir, max_bytes)
+
+    def generate(cmd, tools, args, source, target):
+        """A task running cmd, one of tools, through the resource cache if there is one."""
+        source = source + tools
+        if cache is None:
+            bld(rule = cmd, source = source, target = target)
+            return
+        env = bld.env.derive()
+        env.RESOURCE_CMD = cmd
+        env.RESOURCE_TOOLS = [node.abspath() for node in tools]
+        env.RESOURCE_ARGS = args
+        bld(rule = resource_cache.cached_rule,
+            vars = ['RESOURCE_CMD', 'RESOURCE_ARGS'],
+            env = env,
+            source = source,
+            target = target)
 
     pack_entries = []
+    pack_priorities = {}
     font_keys = []
+    font_files = []
+    font_specs = {}
 
     def deploy_generator(entry):
         res_type = entry["type"]
         def_name = entry["defName"]
         input_file = str(entry["file"])
+        priority = int(entry.get("packPriority", 0))
 
         if res_type == "raw":
             output_node = res_src_node.get_bld().make_node(input_file)
             input_node = res_src_node.find_node(input_file)
 
             pack_entries.append( (output_node, def_name) )
+            pack_priorities[def_name] = priority
             bld(rule = "cp ${SRC} ${TGT}",
                 source = input_node,
                 target = output_node)
@@ -44,9 +136,11 @@ def gen_resource_deps(bld,
             input_png = res_src_node.find_node(input_file)
 
             pack_entries.append( (output_pbi, def_name) )
-            bld(rule = "python {} pbi {} {}".format(bitmap_script.abspath(), input_png.abspath(), output_pbi.abspath()),
-                source = [input_png, bitmap_script],
-                target = output_pbi)
+            pack_priorities[def_name] = priority
+            generate("python {} pbi {} {}".format(bitmap_script.abspath(), input_png.abspath(), output_pbi.abspath()),
+                     bitmap_tools, 'pbi',
+                     source = [input_png],
+                     target = output_pbi)
 
         elif res_type == "png-trans":
             output_white_pbi = res_src_node.get_bld().make_node(input_file + '.white.pbi' )
@@ -55,43 +149,38 @@ def gen_resource_deps(bld,
 
             pack_entries.append( (output_white_pbi, def_name + "_WHITE") )
             pack_entries.append( (output_black_pbi, def_name + "_BLACK") )
+            pack_priorities[def_name + "_WHITE"] = priority
+            pack_priorities[def_name + "_BLACK"] = priority
 
-            bld(rule = "python {} white_trans_pbi {} {}".format(bitmap_script.abspath(), input_png.abspath(), output_white_pbi.abspath()),
-                source = [input_png, bitmap_script],
-                target = output_white_pbi)
-            bld(rule = "python {} black_trans_pbi {} {}".format(bitmap_script.abspath(), input_png.abspath(), output_black_pbi.abspath()),
-                source = [input_png, bitmap_script],
-                target = output_black_pbi)
+            generate("python {} trans_pair {} {} {}".format(bitmap_script.abspath(), input_png.abspath(), output_white_pbi.abspath(), output_black_pbi.abspath()),
+                     bitmap_tools, 'trans_pair',
+                     source = [input_png],
+                     target = [output_white_pbi, output_black_pbi])
 
         elif res_type == "font":
             output_pfo = res_src_node.get_bld().make_node(input_file + '.' + str(def_name) + '.pfo')
-            input_ttf = res_src_node.find_node(input_file)
             m = re.search('([0-9]+)', def_name)
             if m == None:
                 if def_name != 'FONT_FALLBACK':
-                    raise ValueError('Font {0}: no height found in def name\n'.format(self.def_name))
+                    raise ValueError('Font {0}: no height found in def name\n'.format(def_name))
                 height = 14
             else:
                 height = int(m.group(0))
 
             pack_entries.append( (output_pfo, def_name) )
+            pack_priorities[def_name] = priority
             font_keys.append(def_name)
+
+            # All sizes of a ttf are rendered by a single fontgen process, see below
+            spec = { 'height': height }
             if 'trackingAdjust' in entry:
-                trackingAdjustArg = '--tracking %i' % entry['trackingAdjust']
-            else:
-                trackingAdjustArg = ''
+                spec['tracking'] = entry['trackingAdjust']
             if 'characterRegex' in entry:
-                characterRegexArg = '--filter "%s"' % entry['characterRegex']
-            else:
-                characterRegexArg = ''
-            bld(rule = "python {} pfo {} {} {} {} {}".format(font_script.abspath(),
-                                                                      height,
-                                                                      trackingAdjustArg,
-                                                                      characterRegexArg,
-                                                                      input_ttf.abspath(),
-                                                                      output_pfo.abspath()),
-                source = [input_ttf, font_script],
-                target = output_pfo)
+                spec['filter'] = entry['characterRegex']
+            if input_file not in font_specs:
+                font_files.append(input_file)
+                font_specs[input_file] = []
+            font_specs[input_file].append( (output_pfo, spec) )
         else:
             waflib.Logs.error("Error Generating Resources: File: " + input_file + " has specified invalid type: " + res_type)
             waflib.Logs.error("Must be one of (raw, png, png-trans, font)")
@@ -110,80 +199,87 @@ def gen_resource_deps(bld,
     for res in map_data["media"]:
         deploy_generator(res)
 
-    # concat all of the pack entries
-    manifest_node = res_src_node.get_bld().make_node(os.path.basename(pack_node.relpath()) + '.manifest')
-    table_node = res_src_node.get_bld().make_node(os.path.basename(pack_node.relpath()) + '.table')
-    data_node = res_src_node.get_bld().make_node(os.path.basename(pack_node.relpath()) + '.data')
-
-    md_script = bld.path.parent.find_node('tools/pbpack_meta_data.py')
-    resource_code_script = bld.path.parent.find_node('tools/generate_resource_code.py')
+    glyph_cache_args = ''
+    if glyph_cache and font_files:
+        stats_node = bld.bldnode.make_node('glyph_cache.stats')
+        if os.path.exists(stats_node.abspath()):
+            os.remove(stats_node.abspath())
+        glyph_cache_args = '--glyph-cache {} --glyph-cache-stats {}'.format(
+            pipes.quote(os.path.abspath(os.path.expanduser(glyph_cache))),
+            stats_node.abspath())
+        bld.add_post_fun(lambda ctx: report_glyph_cache_stats(stats_node.abspath()))
+
+    for input_file in font_files:
+        input_ttf = res_src_node.find_node(input_file)
+        specs = []
+        for output_pfo, spec in font_specs[input_file]:
+            spec = dict(spec, output=output_pfo.abspath())
+            specs.append(pipes.quote(json.dumps(spec, sort_keys=True)))
+        # The cache key leaves out the output paths, which differ between projects
+        cache_args = 'multi ' + json.dumps([spec for _, spec in font_specs[input_file]], sort_keys=True)
+        generate("python {} multi {} {} {}".format(font_script.abspath(),
+                                                   glyph_cache_args,
+                                                   input_ttf.abspath(),
+                                                   ' '.join(specs)),
+                 font_tools, cache_args,
+                 source = [input_ttf],
+                 target = [output_pfo for output_pfo, _ in font_specs[input_file]])
+
+    # build the .pbpack and the resource ids header from it in one pass
+    pack_script = tools_node.find_node('pbpack.py')
+
+    # The pack script and the modules it imports
+    pack_tools = [pack_script] + [tools_node.find_node(m) for m in
+                                  ('generate_resource_code.py', 'fileutil.py', 'packbits.py',
+                                   'stm32_crc.py', 'pbpack_meta_data.py')]
 
     data_sources = []
 
-    cat_string = "cat"
-    table_string = "python {} table {}".format(md_script.abspath(), table_node.abspath())
-    resource_header_string = "python {script} resource_header {output_header} {version_def_name} {readable_version} {timestamp} {resource_include} {data_file}".format(
-        script=resource_code_script.abspath(),
-        output_header=id_header_node.abspath(),
-        version_def_name=version_def_name,
-        readable_version=readable_version,
+    # The pack is patched in place when only the contents of its entries change
+    pack_string = "python {script} build --incremental {pack_file} {timestamp} {readable_version}".format(
+        script=pack_script.abspath(),
+        pack_file=pack_node.abspath(),
         timestamp=timestamp,
-        resource_include=resource_header_path,
-        data_file=data_node.abspath())
+        readable_version=readable_version)
 
     for entry in pack_entries:
-        cat_string += ' ' + entry[0].abspath()
         data_sources.append(entry[0])
-        table_string += ' ' + entry[0].abspath()
-        resource_header_string += ' ' + str(entry[0].abspath()) + ' ' + str(entry[1])
-
-    cat_string += ' > ' + data_node.abspath()
-
-    bld(rule = cat_string,
-        source = data_sources,
-        target = data_node)
-
-    bld(rule = table_string,
-        source = data_sources + [md_script],
-        target = table_node)
-
-
-    bld(rule = "python {script} manifest {output_file} {num_files} {timestamp} {readable_version} {data_chunk_file}".format(
-            script = md_script.abspath(),
-            output_file = manifest_node.abspath(),
-            num_files = len(pack_entries),
-            timestamp = timestamp,
-            readable_version = readable_version,
-            data_chunk_file = data_node.abspath()),
-        source = [data_node, md_script],
-        target = manifest_node)
-
-    # make the actual .pbpack
-    bld(rule = "cat {} {} {} > {}".format(manifest_node.abspath(), table_node.abspath(), data_node.abspath(), pack_node.abspath()),
-        source = [manifest_node, table_node, data_node],
-        target = pack_node)
-
-    # resource ids header
-    bld(rule=resource_header_string,
-        source = data_sources + [resource_code_script, data_node],
-        target = id_header_node)
+        pack_string += ' ' + str(entry[0].abspath()) + ' ' + str(entry[1])
+
+    if sparse_table:
+        pack_string += " --sparse-table"
+    if dedup:
+        pack_string += " --dedup"
+    if compress:
+        pack_string += " --compress --compression-report {}".format(pack_node.abspath() + '.compression.txt')
+    if align:
+        pack_string += " --align {}".format(int(align))
+    for def_name, priority in sorted(pack_priorities.items()):
+        if priority:
+            pack_string += " --priority {} {}".format(def_name, priority)
+
+    pack_string += " --resource-header {output_header} --version-def-name {version_def_name} --resource-include {resource_include}".format(
+        output_header=id_header_node.abspath(),
+        version_def_name=version_def_name,
+        resource_include=resource_header_path)
+    pack_targets = [pack_node, id_header_node]
+    if version_source_node:
+        pack_string += " --version-source {}".format(version_source_node.abspath())
+        pack_targets.append(version_source_node)
 
-    # font definition files
+    # font definition files, written by the same task from the pack's metadata
     if font_key_header_node and font_key_table_node and font_key_include_path:
-        key_list_string = " ".join(font_keys)
-
-        bld(rule="python {script} font_key_header {font_key_header} {key_list}".format(
-                script=resource_code_script.abspath(),
-                font_key_header=font_key_header_node.abspath(),
-                key_list=key_list_string),
-            source=resource_code_script,
-            target=font_key_header_node)
-
-        bld(rule="python {script} font_key_table {font_key_table} {resource_id_header} {font_key_header} {key_list}".format(
-                script=resource_code_script.abspath(),
-                font_key_table=font_key_table_node.abspath(),
-                resource_id_header=resource_header_path,
-                font_key_header=font_key_include_path,
-                key_list=key_list_string),
-            source=resource_code_script,
-            target=font_key_table_node)
+        pack_string += " --font-key-header {font_key_header} --font-key-table {font_key_table} --font-key-include {font_key_include}".format(
+            font_key_header=font_key_header_node.abspath(),
+            font_key_table=font_key_table_node.abspath(),
+            font_key_include=font_key_include_path)
+        if font_keys:
+            pack_string += " --font-keys {}".format(" ".join(font_keys))
+        pack_targets += [font_key_header_node, font_key_table_node]
+
+    # Compiled sources depend on the contents of these outputs, not on the
+    # task having run
+    bld(rule = pack_string,
+        source = data_sources + pack_tools,
+        target = pack_targets,
+        update_outputs = True)
@@ -0,0 +1,157 @@
+# Content-addressed cache of generated resources, shared between projects
+# and builds.
+#
+# A resource's key is the hash of everything its output depends on: the
+# contents of its inputs, the generator script and the modules it imports
+# (standing in for the tool's version), and a description of its arguments
+# that doesn't mention any paths, so the same image or font used by two
+# projects hits the same entry. Every output of a task is stored as a file
+# named after the key and the output's index.
+#
+# Storage and eviction are cache_dir's. Hits are hardlinked into the build
+# directory when the cache is on the same filesystem and copied otherwise;
+# the generators replace their outputs rather than writing into them, so a
+# linked entry is never modified.
+
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import waflib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+import cache_dir
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+# Bump to invalidate every entry, e.g. when the key's fields change
+CACHE_FORMAT = 1
+
+class ResourceCache(cache_dir.CacheDirectory):
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        super(ResourceCache, self).__init__(directory, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.tool_hashes = {}
+
+    def tool_hash(self, tool_paths):
+        """Hash of a generator: its script and every module it imports."""
+        tool_paths = tuple(tool_paths)
+        with self.lock:
+            if tool_paths in self.tool_hashes:
+                return self.tool_hashes[tool_paths]
+        h = hashlib.sha1()
+        for path in tool_paths:
+            h.update(os.path.basename(path) + '\0' + _file_hash(path) + '\0')
+        digest = h.hexdigest()
+        with self.lock:
+            self.tool_hashes[tool_paths] = digest
+        return digest
+
+    def key(self, tool_paths, input_paths, args):
+        h = hashlib.sha1('{}\0{}\0{}\0'.format(CACHE_FORMAT, self.tool_hash(tool_paths), args))
+        for path in input_paths:
+            h.update(_file_hash(path) + '\0')
+        return h.hexdigest()
+
+    def _path(self, key, index):
+        return '{}-{}'.format(self.entry_path(key), index)
+
+    def fetch(self, key, output_paths):
+        """Materialize the outputs stored under key. Returns whether they all were."""
+        entries = [self._path(key, i) for i in xrange(len(output_paths))]
+        if not all(os.path.exists(entry) for entry in entries):
+            with self.lock:
+                self.misses += 1
+            return False
+        try:
+            for entry, output_path in zip(entries, output_paths):
+                _link_or_copy(entry, output_path)
+                os.utime(entry, None)
+        except (IOError, OSError) as e:
+            # Evicted by another build halfway through
+            if e.errno != errno.ENOENT:
+                raise
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, output_paths):
+        for i, output_path in enumerate(output_paths):
+            with self.write_entry(self._path(key, i)) as f:
+                with open(output_path, 'rb') as output_file:
+                    shutil.copyfileobj(output_file, f)
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(64 * 1024), ''):
+            h.update(block)
+    return h.hexdigest()
+
+def _link_or_copy(entry, output_path):
+    fd, temp_path = tempfile.mkstemp(prefix=cache_dir.TEMP_PREFIX, dir=os.path.dirname(output_path))
+    os.close(fd)
+    try:
+        os.remove(temp_path)
+        try:
+            os.link(entry, temp_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(entry, temp_path)
+        os.rename(temp_path, output_path)
+    except:
+        cache_dir.remove_quietly(temp_path)
+        raise
+
+def get_cache(bld, directory, max_bytes=None):
+    """
+    The build's ResourceCache for directory, holding at most max_bytes
+    (DEFAULT_MAX_BYTES by default), reporting its hit rate when the build
+    ends.
+    """
+    directory = os.path.abspath(os.path.expanduser(directory))
+    cache = getattr(bld, 'resource_cache', None)
+    if cache is None or cache.directory != directory:
+        cache = bld.resource_cache = ResourceCache(directory, max_bytes or DEFAULT_MAX_BYTES)
+        bld.add_post_fun(lambda ctx: _finish(cache))
+    return cache
+
+def _finish(cache):
+    cache.close()
+    lookups = cache.hits + cache.misses
+    if lookups:
+        waflib.Logs.info("Resource cache: {} hits, {} misses ({:.0f}% hit rate)".format(
+            cache.hits, cache.misses, 100.0 * cache.hits / lookups))
+
+def cached_rule(task):
+    """
+    waf rule running the shell command task.env.RESOURCE_CMD, unless the
+    build's resource cache already holds its outputs. task.env.RESOURCE_ARGS
+    describes the command's arguments for the key, and task.env.RESOURCE_TOOLS
+    lists the generator script and the modules it imports.
+    """
+    cache = task.generator.bld.resource_cache
+    output_paths = [node.abspath() for node in task.outputs]
+    key = cache.key(task.env.RESOURCE_TOOLS,
+                    [node.abspath() for node in task.inputs],
+                    task.env.RESOURCE_ARGS)
+    if cache.fetch(key, output_paths):
+        return 0
+
+    # Don't write through a link into the cache left by an earlier hit
+    for path in output_paths:
+        cache_dir.remove_quietly(path)
+    ret = task.exec_command(task.env.RESOURCE_CMD)
+    if not ret:
+        cache.store(key, output_paths)
+    return ret